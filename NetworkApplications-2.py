@@ -2,12 +2,40 @@
 # -*- coding: UTF-8 -*-
 
 import argparse
+import asyncio
+import bisect
+import collections
+import concurrent.futures
+import email.utils
+import gzip
+import errno
+import hashlib
+import ipaddress
+import json
+import math
+import mimetypes
+import mmap
+import platform
 import socket
 import os
+import re
+import resource
 import sys
 import struct
+import subprocess
+import tempfile
 import select
+import signal
+import selectors
 import time
+import timeit
+import traceback
+import urllib.parse
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 
@@ -15,51 +43,228 @@ import time
 #linux terminal 'curl 127.0.0.1:8080/index.html.
 
 ICMP_ECHO = 8
+ICMP_ECHO_REPLY = 0
 ID = 1
 port = 8080
 ICMP_ECHO_REQUEST = 8
 ICMP_TIME_EXCEEDED = 11
+ICMP_DEST_UNREACHABLE = 3
 MAX_HOPS = 64
+TRACEROUTE_PORT = 33434
+#UDP flow n is sent from this port plus n, ICMP flow n keeps its checksum at this value plus n.
+TRACEROUTE_SOURCE_PORT = 24576
+PARIS_ICMP_CHECKSUM = 0x8000
+MAX_FLOWS = 1024
+#Kernel receive timestamps, Linux only. Python doesn't export the constant so it is spelled out here.
+SO_TIMESTAMPNS = getattr(socket, 'SO_TIMESTAMPNS', 35 if sys.platform.startswith('linux') else None)
+TIMESPEC = struct.Struct('@ll')
+NUMPY_CHECKSUM_THRESHOLD = 4096
+#Sequence number and send time, the part of an echo request that changes from probe to probe.
+ECHO_STAMP = struct.Struct('=Hd')
+ECHO_CHECKSUM = struct.Struct('!H')
+#Header plus timestamp, buildEchoRequest sends no other payload.
+ECHO_REQUEST_SIZE = 16
+FLOOD_INTERVAL = 0.01
+#Upper bounds in ms of the latency histogram buckets, 20 per decade from 10 us to 100 s.
+LATENCY_BUCKET_BOUNDS = [0.01 * 10 ** (i / 20) for i in range(161)]
+PROBE_RECORD_MAGIC = b'NAPROBE1'
+#Header: magic, record size, capacity, records written so far. Records start PROBE_RECORD_HEADER_SIZE in.
+PROBE_RECORD_HEADER = struct.Struct('<8sIIQ')
+PROBE_RECORD_HEADER_SIZE = 64
+PROBE_RECORD_COUNT = struct.Struct('<Q')
+PROBE_RECORD_COUNT_OFFSET = 16
+#Send time, target, responder, sequence, TTL, ICMP type, RTT in ms: 24 bytes.
+PROBE_RECORD = struct.Struct('<d4s4sHBBf')
+PROBE_RECORD_CHUNK = 4096
+PROBE_LOST = 0xFF
+DEFAULT_RECORD_CAPACITY = 131072
+DNS_CACHE_TTL = 300
+DNS_TIMEOUT = 2.0
+RECV_BUFFER_SIZE = 65536
+MAX_REQUEST_SIZE = 65536
+MAX_REQUEST_LINE = 8192
+MAX_HEADER_FIELDS = 100
+#Method and header field names (RFC 7230 section 3.2.6).
+HTTP_TOKEN = re.compile(r"[!#$%&'*+\-.^_`|~0-9A-Za-z]+")
+#open() errors that mean there is no such file to serve.
+NOT_FOUND_ERRNOS = (errno.ENOENT, errno.ENOTDIR, errno.EISDIR, errno.ENAMETOOLONG)
+REFUSAL_REASONS = {400: 'Bad Request', 414: 'URI Too Long', 431: 'Request Header Fields Too Large'}
+MAX_RANGES = 64
+SHUTDOWN_GRACE_PERIOD = 10
+GZIP_LEVEL = 6
+GZIP_MIN_SIZE = 256
+COMPRESSIBLE_TYPES = ('text/', 'application/javascript', 'application/json', 'application/xml',
+                      'application/xhtml+xml', 'application/wasm', 'image/svg+xml')
+#Content types for compressed files served as they are, by the encoding mimetypes guesses from the name.
+ENCODED_FILE_TYPES = {'gzip': 'application/gzip', 'bzip2': 'application/x-bzip2', 'xz': 'application/x-xz',
+                      'compress': 'application/x-compress', 'br': 'application/x-brotli'}
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE', 'TRACE')
+CACHEABLE_STATUS_CODES = (200, 203, 300, 301, 404, 410)
+HOP_BY_HOP_HEADERS = ('connection', 'keep-alive', 'proxy-connection', 'proxy-authenticate',
+                      'proxy-authorization', 'te', 'trailer', 'transfer-encoding', 'upgrade')
+SEND_CHUNK_SIZE = 65536
+TUNNEL_BUFFER_SIZE = 65536
+BENCHMARK_START_TIMEOUT = 10.0
+BENCHMARK_REPEATS = 7
+METRICS_PATH = '/__metrics'
+METRIC_BUCKET_BOUNDS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                        0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
 
 
 def setupArgumentParser() -> argparse.Namespace:
         parser = argparse.ArgumentParser(
             description='A collection of Network Applications developed for SCC.203.')
-        parser.set_defaults(func=ICMPPing, hostname='lancaster.ac.uk')
+        #Run with no sub-command it pings lancaster.ac.uk with the same defaults as the ping sub-command.
+        parser.set_defaults(func=ICMPPing, hostname='lancaster.ac.uk', hosts=[], sweep=False, count=None,
+                            timeout=4, interval=1.0, flood=False, record=None,
+                            record_capacity=DEFAULT_RECORD_CAPACITY)
         subparsers = parser.add_subparsers(help='sub-command help')
         
         parser_p = subparsers.add_parser('ping', aliases=['p'], help='run ping')
-        parser_p.set_defaults(timeout=4)
+        parser_p.set_defaults(timeout=4, interval=1.0)
         parser_p.add_argument('hostname', type=str, help='host to ping towards')
+        parser_p.add_argument('hosts', type=str, nargs='*',
+                              help='further hosts or CIDR ranges to sweep at the same time')
+        parser_p.add_argument('--sweep', '-s', action='store_true',
+                              help='ping every host in parallel and report which are alive')
         parser_p.add_argument('--count', '-c', nargs='?', type=int,
                               help='number of times to ping the host before stopping')
-        parser_p.add_argument('--timeout', '-t', nargs='?',
-                              type=int,
+        parser_p.add_argument('--timeout', '-t', type=float,
                               help='maximum timeout before considering request lost')
+        parser_p.add_argument('--interval', '-i', type=float,
+                              help='seconds to wait between sending each probe')
+        parser_p.add_argument('--flood', '-f', action='store_true',
+                              help='send the next probe as soon as a reply comes back')
+        parser_p.add_argument('--record', type=str,
+                              help='ring file every probe result is appended to')
+        parser_p.add_argument('--record-capacity', type=int, default=DEFAULT_RECORD_CAPACITY,
+                              help='records a new ring file holds before the oldest are overwritten')
         parser_p.set_defaults(func=ICMPPing)
 
         parser_t = subparsers.add_parser('traceroute', aliases=['t'],
                                          help='run traceroute')
         parser_t.set_defaults(timeout=4, protocol='icmp')
         parser_t.add_argument('hostname', type=str, help='host to traceroute towards')
-        parser_t.add_argument('--timeout', '-t', nargs='?', type=int,
+        parser_t.add_argument('--timeout', '-t', type=int,
                               help='maximum timeout before considering request lost')
-        parser_t.add_argument('--protocol', '-p', nargs='?', type=str,
+        parser_t.add_argument('--protocol', '-p', type=str,
                               help='protocol to send request with (UDP/ICMP)')
+        parser_t.add_argument('--flows', '-f', type=int, default=1,
+                              help='number of flows to trace at once, more than one maps every load-balanced path')
+        parser_t.add_argument('--flow-id', type=int, default=0,
+                              help='flow identifier of the first flow, the same ID follows the same path each run')
+        parser_t.add_argument('--max-hops', '-m', type=int, default=30,
+                              help='largest TTL probed')
+        parser_t.add_argument('--queries', '-q', type=int, default=3,
+                              help='number of probes sent to each hop')
+        parser_t.add_argument('--numeric', '-n', action='store_true',
+                              help='print hop addresses without looking up their names')
+        parser_t.add_argument('--record', type=str,
+                              help='ring file every probe result is appended to')
+        parser_t.add_argument('--record-capacity', type=int, default=DEFAULT_RECORD_CAPACITY,
+                              help='records a new ring file holds before the oldest are overwritten')
         parser_t.set_defaults(func=Traceroute)
 
+        parser_r = subparsers.add_parser('records', aliases=['r'],
+                                         help='read a file written with ping or traceroute --record')
+        parser_r.add_argument('file', type=str, help='ring file to read')
+        parser_r.add_argument('--summary', '-s', action='store_true',
+                              help='print loss and RTT statistics for each target and TTL instead of every record')
+        parser_r.add_argument('--target', type=str, help='only read records for this address')
+        parser_r.add_argument('--since', type=float, help='only read records from the last this many seconds')
+        parser_r.set_defaults(func=ProbeRecords)
+
         parser_w = subparsers.add_parser('web', aliases=['w'], help='run web server')
         parser_w.set_defaults(port=8080)
         parser_w.add_argument('--port', '-p', type=int, nargs='?',
                               help='port number to start web server listening on')
+        parser_w.add_argument('--backlog', '-b', type=int, default=1024,
+                              help='length of the queue of connections waiting to be accepted')
+        parser_w.add_argument('--max-connections', '-m', type=int, default=4096,
+                              help='maximum number of client connections open at once')
+        parser_w.add_argument('--keepalive-timeout', '-k', type=float, default=15.0,
+                              help='seconds an idle persistent connection is kept open')
+        parser_w.add_argument('--max-requests', '-r', type=int, default=100,
+                              help='maximum number of requests served on one connection')
+        parser_w.add_argument('--root', default='.',
+                              help='document root directory that files are served from')
+        parser_w.add_argument('--cache-size', type=int, default=0,
+                              help='bytes of memory used to cache hot files (0 disables the cache)')
+        parser_w.add_argument('--cache-max-file', type=int, default=1048576,
+                              help='largest file in bytes that will be cached')
+        parser_w.add_argument('--cache-check-interval', type=float, default=1.0,
+                              help='seconds a cached file is served before checking it for changes')
+        parser_w.add_argument('--gzip-cache-size', type=int, default=16777216,
+                              help='bytes of memory for gzipped copies of text files (0 turns on-the-fly gzip off)')
+        parser_w.add_argument('--gzip-max-file', type=int, default=1048576,
+                              help='largest file in bytes that will be gzipped on the fly')
+        parser_w.add_argument('--workers', '-w', type=int, default=1,
+                              help='number of worker processes serving connections')
+        parser_w.add_argument('--stats-interval', type=float, default=0,
+                              help='seconds between stats lines printed to stderr (0 disables them)')
+        parser_w.add_argument('--reuseport', action='store_true',
+                              help='have each worker bind the port with SO_REUSEPORT instead of sharing one socket')
         parser_w.set_defaults(func=WebServer)
 
         parser_x = subparsers.add_parser('proxy', aliases=['x'], help='run proxy')
         parser_x.set_defaults(port=8000)
         parser_x.add_argument('--port', '-p', type=int, nargs='?',
                               help='port number to start web server listening on')
+        parser_x.add_argument('--backlog', '-b', type=int, default=1024,
+                              help='length of the queue of connections waiting to be accepted')
+        parser_x.add_argument('--timeout', '-t', type=float, default=30.0,
+                              help='seconds to wait for the origin server before giving up')
+        parser_x.add_argument('--keepalive-timeout', '-k', type=float, default=15.0,
+                              help='seconds an idle client connection is kept open')
+        parser_x.add_argument('--cache-dir', type=str, default='.proxycache',
+                              help='directory cached responses are stored in')
+        parser_x.add_argument('--cache-size', type=int, default=268435456,
+                              help='bytes of disk the response cache may use')
+        parser_x.add_argument('--max-object-size', type=int, default=16777216,
+                              help='largest response body in bytes that will be cached')
+        parser_x.add_argument('--max-idle-upstream', type=int, default=8,
+                              help='idle connections kept open to each origin server')
+        parser_x.add_argument('--upstream-idle-timeout', type=float, default=30.0,
+                              help='seconds an idle origin connection is kept before closing it')
+        parser_x.add_argument('--connect-ports', type=str, default='443',
+                              help='comma separated ports CONNECT may open tunnels to')
+        parser_x.add_argument('--tunnel-timeout', type=float, default=300.0,
+                              help='seconds a CONNECT tunnel may go without traffic before it is closed')
+        parser_x.add_argument('--stats-interval', type=float, default=0,
+                              help='seconds between stats lines printed to stderr (0 disables them)')
         parser_x.set_defaults(func=Proxy)
 
+        parser_b = subparsers.add_parser('benchmark', aliases=['b'],
+                                         help='load test the web server or proxy on localhost')
+        parser_b.add_argument('server', nargs='?', choices=['web', 'proxy'], default='web',
+                              help='server to load test (the proxy is put in front of a web server)')
+        parser_b.add_argument('--port', '-p', type=int, default=8090,
+                              help='port the server under test listens on (the proxy\'s origin uses the next one)')
+        parser_b.add_argument('--clients', '-c', type=int, default=16,
+                              help='number of concurrent keep-alive clients')
+        parser_b.add_argument('--duration', '-d', type=float, default=5.0,
+                              help='seconds each file size is requested for')
+        parser_b.add_argument('--runs', '-r', type=int, default=3,
+                              help='load test runs per file size, the fastest is reported')
+        parser_b.add_argument('--sizes', '-s', type=str, default='1024,65536,1048576',
+                              help='comma separated sizes in bytes of the files requested')
+        parser_b.add_argument('--server-arg', action='append',
+                              help='extra argument for the web server, e.g. --server-arg=--cache-size=1048576')
+        parser_b.add_argument('--json', type=str,
+                              help='file to write the results to as JSON (- for standard output)')
+        parser_b.add_argument('--baseline', type=str,
+                              help='JSON results to compare against, exiting with status 1 on a regression '
+                                   '(benchmark-baseline.json holds reference results for the web server)')
+        parser_b.add_argument('--save-baseline', type=str,
+                              help='file to save these results to for later comparisons')
+        parser_b.add_argument('--tolerance', type=float, default=0.3,
+                              help='fraction a load test metric may get worse by before it counts as a regression')
+        parser_b.add_argument('--micro-tolerance', type=float, default=1.0,
+                              help='fraction a microbenchmark may get slower by before it counts as a regression')
+        parser_b.add_argument('--skip-load', action='store_true', help='only run the microbenchmarks')
+        parser_b.add_argument('--skip-micro', action='store_true', help='only run the load test')
+        parser_b.set_defaults(func=Benchmark)
+
         args = parser.parse_args()
         return args
 
@@ -67,34 +272,399 @@ def setupArgumentParser() -> argparse.Namespace:
 class NetworkApplication:
 
     def checksum(self,str):
-        csum = 0
-        countTo = (len(str) / 2) * 2
-        count = 0
-        while count < countTo:
-            thisVal = str[count + 1] * 256 + str[count]
-            csum = csum + thisVal
-            csum = csum & 0xffffffff
-            count = count + 2
-        if countTo < len(str):
-            csum = csum + str[len(str) - 1].decode()
-            csum = csum & 0xffffffff
-        csum = (csum >> 16) + (csum & 0xffff)
-        csum = csum + (csum >> 16)
+        #Internet checksum (RFC 1071) summed a whole buffer of 16-bit words at a time instead of one per
+        #loop iteration. Odd-length input is padded with a zero byte. The result is byte swapped so that
+        #socket.htons() gives the value to pack with "H", as the callers expect.
+        data = memoryview(str).cast('B')
+        evenLength = len(data) & ~1
+        if numpy is not None and evenLength >= NUMPY_CHECKSUM_THRESHOLD:
+            csum = int(numpy.frombuffer(data[:evenLength], dtype='<u2').sum(dtype=numpy.uint64))
+            if evenLength < len(data):
+                csum = csum + data[evenLength]
+        else:
+            #Read as one little-endian number the buffer is a sum of its words times powers of 0x10000,
+            #and 0x10000 is 1 mod 0xffff, so the remainder is the folded word sum. A trailing odd byte
+            #lands in the low half of a last word, which is the zero padding. Nonzero multiples fold to 0xffff.
+            total = int.from_bytes(data, 'little')
+            csum = total % 0xffff or (0xffff if total else 0)
+
+        #Fold the carries back in until the sum fits in 16 bits.
+        while csum >> 16:
+            csum = (csum >> 16) + (csum & 0xffff)
         answer = ~csum
         answer = answer & 0xffff
         answer = answer >> 8 | (answer << 8 & 0xff00)
         return answer
 
+    def echoFixedSum(self, packet):
+        #Sum of the echo request words that never change between probes: type and code, and the identifier.
+        #Folded to 16 bits so that adding the changing words needs only one more fold. Only the bare
+        #ECHO_REQUEST_SIZE byte request from buildEchoRequest is supported, a payload would go unsummed.
+        if len(packet) != ECHO_REQUEST_SIZE:
+            raise ValueError('echo request with a payload can not be updated in place')
+        fixedSum = (packet[0] << 8 | packet[1]) + (packet[4] << 8 | packet[5])
+        return (fixedSum >> 16) + (fixedSum & 0xffff)
+
+    def updateEchoRequest(self, packet, sequence, fixedSum=None):
+        #Reuses an echo request built by buildEchoRequest for the next probe. Only the sequence number and
+        #timestamp change, so the checksum is fixedSum from echoFixedSum plus those five words, summed in one
+        #int.from_bytes as in checksum(). Words are summed in network order, the checksum doesn't mind which.
+        #The timestamp is the last thing in the packet, see echoFixedSum.
+        if fixedSum is None:
+            fixedSum = self.echoFixedSum(packet)
+        ECHO_STAMP.pack_into(packet, 6, sequence, time.time())
+        csum = fixedSum + int.from_bytes(packet[6:16], 'big') % 0xffff
+        ECHO_CHECKSUM.pack_into(packet, 2, ~((csum >> 16) + (csum & 0xffff)) & 0xffff)
+        return packet
+
+    def parseHeaders(self, lines):
+        #Turns raw 'Name: value' lines into a list of (name, value) pairs, None if any line is malformed.
+        headers = []
+        for line in lines:
+            name, separator, value = line.partition(b':')
+            if not separator or not name.strip():
+                return None
+            headers.append((name.strip().decode('latin-1'), value.strip().decode('latin-1')))
+        return headers
+
+    def parseRequestHead(self, buffer, headerEnd):
+        #Parses a request head straight out of a receive buffer, returning (method, target, version, fields)
+        #or the status code to refuse the request with. fields is as headerFields returns it. Both servers
+        #use this so they accept exactly the same requests.
+        #The head is decoded once without copying the buffer and everything after that is split out of the one string.
+        with memoryview(buffer) as view:
+            head = str(view[:headerEnd], 'latin-1')
+        lines = head.split('\r\n')
+        if len(lines[0]) > MAX_REQUEST_LINE:
+            return 414
+        if len(lines) > MAX_HEADER_FIELDS + 1:
+            return 431
+        request_Parts = lines[0].split(' ')
+        if (len(request_Parts) != 3 or not HTTP_TOKEN.fullmatch(request_Parts[0]) or not request_Parts[1]
+                or len(request_Parts[2]) != 8 or not request_Parts[2].startswith('HTTP/1.')):
+            return 400
+
+        fields = {}
+        for line in lines[1:]:
+            #Names are tokens, so whitespace before the colon and folded lines are refused (RFC 7230 section 3.2.4).
+            name, colon, value = line.partition(':')
+            if not colon or not HTTP_TOKEN.fullmatch(name):
+                return 400
+            name = name.lower()
+            value = value.strip(' \t')
+            fields[name] = fields[name] + ', ' + value if name in fields else value
+        method, target, version = request_Parts
+        return method, target, version, fields
+
+    def headerFields(self, headers):
+        #Lower-cased name to value lookup, repeated fields are joined with commas as RFC 7230 allows.
+        fields = {}
+        for name, value in headers:
+            name = name.lower()
+            fields[name] = fields[name] + ', ' + value if name in fields else value
+        return fields
+
+    def contentLength(self, fields):
+        #Body length from Content-Length: 0 if there is none, -1 if it isn't just ASCII digits. int() would also
+        #take '+5', '1_0' and other spellings a server in front of or behind us may read differently.
+        value = fields.get('content-length', '0')
+        if not (value.isascii() and value.isdigit()):
+            return -1
+        return int(value)
+
+    def isKeepAlive(self, version, fields):
+        #HTTP/1.1 connections stay open unless the client says otherwise, HTTP/1.0 only if it asks.
+        connection_Tokens = fields.get('connection', '').lower()
+        if version == 'HTTP/1.0':
+            return 'keep-alive' in connection_Tokens
+        return 'close' not in connection_Tokens
+
+    def buildEchoRequest(self, identifier, sequence):
+        #Echo request carrying the send time, with its checksum filled in. Returned as a bytearray so
+        #updateEchoRequest can turn it into the next probe in place.
+        header = struct.pack("bbHHH", ICMP_ECHO, 0, 0, identifier, sequence)
+        data = struct.pack("d", time.time())
+        mychecksum = socket.htons(self.checksum(header + data))
+        header = struct.pack("bbHHH", ICMP_ECHO, 0, mychecksum, identifier, sequence)
+        return bytearray(header + data)
+
+    def parseICMPReply(self, receivedPacket):
+        #Returns (type, code, identifier, sequence) of the probe a reply answers, or None.
+        #Errors such as Time Exceeded quote the IP header and first 8 bytes of the probe that caused them,
+        #so the identifier and sequence come from that quoted copy instead of the reply's own header.
+        #The IP header length is in the low nibble of the first byte, in 32-bit words.
+        ipHeaderLength = (receivedPacket[0] & 0x0F) * 4
+        icmpHeader = receivedPacket[ipHeaderLength:ipHeaderLength + 8]
+        if len(icmpHeader) < 8:
+            return None
+        type, code, checksum, packetID, sequence = struct.unpack("BBHHH", icmpHeader)
+        if type == ICMP_ECHO_REPLY:
+            return type, code, packetID, sequence
+
+        if type in (ICMP_TIME_EXCEEDED, ICMP_DEST_UNREACHABLE):
+            quoted = ipHeaderLength + 8
+            if len(receivedPacket) < quoted + 1:
+                return None
+            quotedHeaderLength = (receivedPacket[quoted] & 0x0F) * 4
+            quotedICMP = receivedPacket[quoted + quotedHeaderLength:quoted + quotedHeaderLength + 8]
+            if len(quotedICMP) < 8 or quotedICMP[0] != ICMP_ECHO:
+                return None
+            quotedType, quotedCode, quotedChecksum, packetID, sequence = struct.unpack("BBHHH", quotedICMP)
+            return type, code, packetID, sequence
+
+        return None
+
+    def parseProbeReply(self, receivedPacket):
+        #Returns (type, code, protocol, destination, header) for the probe a reply answers, or None.
+        #Time Exceeded and Destination Unreachable quote the probe, so protocol, destination and the first
+        #8 bytes of its transport header come from that quoted copy. An Echo Reply carries the probe's
+        #identifier and sequence in its own header, which is returned with no destination.
+        ipHeaderLength = (receivedPacket[0] & 0x0F) * 4
+        icmpHeader = receivedPacket[ipHeaderLength:ipHeaderLength + 8]
+        if len(icmpHeader) < 8:
+            return None
+        type, code = icmpHeader[0], icmpHeader[1]
+        if type == ICMP_ECHO_REPLY:
+            return type, code, socket.IPPROTO_ICMP, None, icmpHeader
+        if type not in (ICMP_TIME_EXCEEDED, ICMP_DEST_UNREACHABLE):
+            return None
+
+        quoted = ipHeaderLength + 8
+        if len(receivedPacket) < quoted + 20:
+            return None
+        quotedHeaderLength = (receivedPacket[quoted] & 0x0F) * 4
+        header = receivedPacket[quoted + quotedHeaderLength:quoted + quotedHeaderLength + 8]
+        if len(header) < 8:
+            return None
+        return (type, code, receivedPacket[quoted + 9], socket.inet_ntoa(receivedPacket[quoted + 16:quoted + 20]),
+                header)
+
     def printOneResult(self, destinationAddress: str, packetLength: int, time: float, ttl: int, destinationHostname=''):
         if destinationHostname:
             print("%d bytes from %s (%s): ttl=%d time=%.2f ms" % (packetLength, destinationHostname, destinationAddress, ttl, time))
         else:
             print("%d bytes from %s: ttl=%d time=%.2f ms" % (packetLength, destinationAddress, ttl, time))
 
-    def printAdditionalDetails(self, packetLoss=0.0, minimumDelay=0.0, averageDelay=0.0, maximumDelay=0.0):
+    def printAdditionalDetails(self, packetLoss=0.0, minimumDelay=0.0, averageDelay=0.0, maximumDelay=0.0, deviation=None):
         print("%.2f%% packet loss" % (packetLoss))
         if minimumDelay > 0 and averageDelay > 0 and maximumDelay > 0:
-            print("rtt min/avg/max = %.2f/%.2f/%.2f ms" % (minimumDelay, averageDelay, maximumDelay))
+            if deviation is None:
+                print("rtt min/avg/max = %.2f/%.2f/%.2f ms" % (minimumDelay, averageDelay, maximumDelay))
+            else:
+                print("rtt min/avg/max/mdev = %.2f/%.2f/%.2f/%.2f ms" % (minimumDelay, averageDelay, maximumDelay, deviation))
+
+
+class ICMPProbeSession(NetworkApplication):
+    #One raw ICMP socket shared by every probe a run sends. Replies are timestamped by the kernel
+    #(SO_TIMESTAMPNS) and converted onto the monotonic clock used for send times, so Python
+    #scheduling delays between the packet arriving and recvmsg() returning don't count towards the RTT.
+
+    protocol = None
+
+    def __init__(self, receiveBufferSize=1 << 20):
+        #getprotobyname reads /etc/protocols, only do it once.
+        if ICMPProbeSession.protocol is None:
+            ICMPProbeSession.protocol = socket.getprotobyname("icmp")
+        self.icmpSocket = socket.socket(socket.AF_INET, socket.SOCK_RAW, ICMPProbeSession.protocol)
+        self.icmpSocket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, receiveBufferSize)
+        self.icmpSocket.setblocking(False)
+        self.ttl = None
+
+        self.kernelTimestamps = False
+        if SO_TIMESTAMPNS is not None and hasattr(self.icmpSocket, 'recvmsg_into'):
+            try:
+                self.icmpSocket.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPNS, 1)
+                self.kernelTimestamps = True
+            except OSError:
+                pass
+        self.ancillarySize = socket.CMSG_SPACE(TIMESPEC.size) if self.kernelTimestamps else 0
+
+        #Replies are received into the same buffer every time.
+        self.recvBuffer = bytearray(RECV_BUFFER_SIZE)
+        self.recvView = memoryview(self.recvBuffer)
+
+        self.identifier = os.getpid() & 0xFFFF
+        self.packet = self.buildEchoRequest(self.identifier, 0)
+        self.packetFixedSum = self.echoFixedSum(self.packet)
+
+    def setTTL(self, ttl):
+        if ttl != self.ttl:
+            self.icmpSocket.setsockopt(socket.IPPROTO_IP, socket.IP_TTL, ttl)
+            self.ttl = ttl
+
+    def send(self, destination, sequence, ttl=None):
+        #Sends the next echo request and returns its monotonic send time, or None if it couldn't go out.
+        return self.sendPacket(destination, self.updateEchoRequest(self.packet, sequence, self.packetFixedSum), ttl)
+
+    def sendPacket(self, destination, packet, ttl=None):
+        #Sends a ready-made ICMP packet, returning its monotonic send time or None if it couldn't go out.
+        if ttl is not None:
+            self.setTTL(ttl)
+        #Stamped before sendto, over loopback the kernel can have the reply queued before sendto returns.
+        time_Sent = time.monotonic()
+        try:
+            try:
+                self.icmpSocket.sendto(packet, (destination, 0))
+            except BlockingIOError:
+                #Send buffer is full, give it a moment to drain and try once more.
+                select.select([], [self.icmpSocket], [], 1)
+                time_Sent = time.monotonic()
+                self.icmpSocket.sendto(packet, (destination, 0))
+        except OSError:
+            return None
+        return time_Sent
+
+    def receive(self, deadline):
+        #Waits until the monotonic deadline for a packet, returning (packet, address, arrival time) or
+        #None once the deadline passes. The packet is a view of a buffer the next call overwrites.
+        while True:
+            remaining = deadline - time.monotonic()
+            if not select.select([self.icmpSocket], [], [], max(0, remaining))[0]:
+                return None
+            try:
+                if self.kernelTimestamps:
+                    length, ancillary, flags, address = self.icmpSocket.recvmsg_into([self.recvBuffer],
+                                                                                     self.ancillarySize)
+                else:
+                    length, address = self.icmpSocket.recvfrom_into(self.recvBuffer)
+                    ancillary = ()
+            except (BlockingIOError, InterruptedError):
+                continue
+            return self.recvView[:length], address, self.arrivalTime(ancillary)
+
+    def arrivalTime(self, ancillary):
+        #The kernel stamps packets with the wall clock, so measure how long ago that was and take it off
+        #the monotonic clock. Without a stamp the time we got the packet is all we have.
+        for level, type, data in ancillary:
+            if level == socket.SOL_SOCKET and type == SO_TIMESTAMPNS and len(data) >= TIMESPEC.size:
+                seconds, nanoseconds = TIMESPEC.unpack_from(data)
+                age = time.time_ns() - (seconds * 1000000000 + nanoseconds)
+                return time.monotonic() - max(0, age) / 1e9
+        return time.monotonic()
+
+    def close(self):
+        self.icmpSocket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class PingStatistics:
+    #Round trip statistics in constant memory: Welford's running mean and variance, min/max and a
+    #fixed set of log-spaced latency buckets for percentiles.
+
+    def __init__(self):
+        self.transmitted = 0
+        self.received = 0
+        self.mean = 0.0
+        self.sumOfSquares = 0.0
+        self.minimum = float('inf')
+        self.maximum = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKET_BOUNDS) + 1)
+
+    def add(self, delay):
+        self.received += 1
+        difference = delay - self.mean
+        self.mean += difference / self.received
+        self.sumOfSquares += difference * (delay - self.mean)
+        self.minimum = min(self.minimum, delay)
+        self.maximum = max(self.maximum, delay)
+        self.buckets[bisect.bisect_left(LATENCY_BUCKET_BOUNDS, delay)] += 1
+
+    def loss(self):
+        if not self.transmitted:
+            return 0.0
+        return 100.0 * (self.transmitted - self.received) / self.transmitted
+
+    def deviation(self):
+        #Population standard deviation, which is what ping reports as mdev.
+        if not self.received:
+            return 0.0
+        return math.sqrt(self.sumOfSquares / self.received)
+
+    def percentile(self, percent):
+        #Estimated by interpolating inside the bucket the percentile falls in, clamped to min/max.
+        if not self.received:
+            return 0.0
+        rank = percent / 100.0 * self.received
+        seen = 0
+        for index, bucketCount in enumerate(self.buckets):
+            if bucketCount and seen + bucketCount >= rank:
+                lower = LATENCY_BUCKET_BOUNDS[index - 1] if index > 0 else self.minimum
+                upper = LATENCY_BUCKET_BOUNDS[index] if index < len(LATENCY_BUCKET_BOUNDS) else self.maximum
+                estimate = lower + (upper - lower) * (rank - seen) / bucketCount
+                return min(max(estimate, self.minimum), self.maximum)
+            seen += bucketCount
+        return self.maximum
+
+class ProbeRecordFile:
+    #Probe results as fixed-size records in a memory-mapped ring file. Once capacity records have been
+    #written the oldest is overwritten, so the file never grows and each write is one pack_into.
+    #A record holds the send time (Unix seconds), target, address that answered, sequence number, TTL
+    #(0 when the system default was used), ICMP type (PROBE_LOST if nothing came back) and RTT in ms.
+
+    def __init__(self, path, capacity=DEFAULT_RECORD_CAPACITY, writable=True):
+        #An existing file keeps the capacity it was created with.
+        if capacity < 1:
+            raise ValueError('record capacity must be at least 1')
+        self.writable = writable
+        fd = os.open(path, os.O_RDWR | os.O_CREAT if writable else os.O_RDONLY, 0o644)
+        try:
+            if writable and os.fstat(fd).st_size == 0:
+                os.ftruncate(fd, PROBE_RECORD_HEADER_SIZE + capacity * PROBE_RECORD.size)
+                os.pwrite(fd, PROBE_RECORD_HEADER.pack(PROBE_RECORD_MAGIC, PROBE_RECORD.size, capacity, 0), 0)
+            if os.fstat(fd).st_size < PROBE_RECORD_HEADER_SIZE:
+                raise ValueError('%s is not a probe record file' % (path))
+            self.map = mmap.mmap(fd, 0, access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ)
+        finally:
+            os.close(fd)
+
+        magic, recordSize, self.capacity, self.written = PROBE_RECORD_HEADER.unpack_from(self.map, 0)
+        if (magic != PROBE_RECORD_MAGIC or recordSize != PROBE_RECORD.size or self.capacity < 1
+                or len(self.map) < PROBE_RECORD_HEADER_SIZE + self.capacity * recordSize):
+            self.map.close()
+            raise ValueError('%s is not a probe record file' % (path))
+        #Send times are taken from the monotonic clock, records hold wall clock time.
+        self.wallOffset = time.time() - time.monotonic()
+
+    def append(self, time_Sent, target, responder, sequence, ttl, icmpType, delay):
+        #responder and delay are None for a probe that got no answer.
+        offset = PROBE_RECORD_HEADER_SIZE + (self.written % self.capacity) * PROBE_RECORD.size
+        PROBE_RECORD.pack_into(self.map, offset, time_Sent + self.wallOffset, socket.inet_aton(target),
+                               socket.inet_aton(responder or '0.0.0.0'), sequence & 0xFFFF, ttl & 0xFF,
+                               icmpType, math.nan if delay is None else delay)
+        #The count is stored after the record, so a reader never counts a slot that isn't filled in yet.
+        self.written += 1
+        PROBE_RECORD_COUNT.pack_into(self.map, PROBE_RECORD_COUNT_OFFSET, self.written)
+
+    def records(self):
+        #Yields (time, target, responder, sequence, ttl, icmpType, delay) oldest first. The map is copied
+        #PROBE_RECORD_CHUNK records at a time, so files of any size are read in constant memory.
+        written = PROBE_RECORD_COUNT.unpack_from(self.map, PROBE_RECORD_COUNT_OFFSET)[0]
+        index = written - min(written, self.capacity)
+        while index < written:
+            slot = index % self.capacity
+            run = min(written - index, self.capacity - slot, PROBE_RECORD_CHUNK)
+            start = PROBE_RECORD_HEADER_SIZE + slot * PROBE_RECORD.size
+            for timestamp, target, responder, sequence, ttl, icmpType, delay in PROBE_RECORD.iter_unpack(
+                    self.map[start:start + run * PROBE_RECORD.size]):
+                yield (timestamp, socket.inet_ntoa(target), socket.inet_ntoa(responder), sequence, ttl,
+                       icmpType, None if icmpType == PROBE_LOST else delay)
+            index += run
+
+    def close(self):
+        if self.writable:
+            self.map.flush()
+        self.map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
 
 
 class ICMPPing(NetworkApplication):
@@ -106,50 +676,20 @@ class ICMPPing(NetworkApplication):
         # 4. Unpack the packet header for useful information, including the ID
         # 5. Check that the ID matches between the request and reply
         # 6. Return total network delay
+        #icmpSocket is an ICMPProbeSession, replies are matched on its identifier and ID as the sequence number.
 
-        #timeLft = Time remaining till timeout
-        timeLft = timeout
-
-        #Start waiting for socket to send a reply back
-        
-        while True:          
-
-            #Header we are unpacking
-            receivedPacket, address = icmpSocket.recvfrom(1024)
-            icmpHeader = receivedPacket[20:28]
-            timeofArrival = time.time()
-
-
-            #Picking exactly what we need from the header and assining it to variables.
-            type, code, checksum, packetID, sequence = struct.unpack("bbHHh", icmpHeader)
-
-            
-
-            
-
-            #Packet ID matches?
-            if ID == packetID:
-                
-                #Assigning the size of the packet in bytes to a variable so I can find the sieze of it for debugging.
-                #bytesInD = struct.calcsize("d")
-                #print(bytesInD," Size of packet")
-
+        #Never wait past the timeout, even if unrelated ICMP traffic keeps arriving.
+        deadline = time_Sent + timeout
+        while True:
+            received = icmpSocket.receive(deadline)
+            if received is None:
+                return None
+            receivedPacket, address, timeofArrival = received
 
+            reply = self.parseICMPReply(receivedPacket)
+            if reply is not None and reply[0] == ICMP_ECHO_REPLY and reply[2] == icmpSocket.identifier and reply[3] == ID:
                 #Measuring total network delay.
-                totalnetDelay = timeofArrival - time_Sent
-
-                
-                return totalnetDelay
-            else: 
-                print("The ID's don't match")
-
-                timeLft = timeofArrival - time_Sent
-
-                if timeLft <= 0:
-
-                    return
-                    
-                pass
+                return timeofArrival - time_Sent
 
     def sendOnePing(self, icmpSocket, destinationAddress, ID):
         # 1. Build ICMP header
@@ -157,37 +697,8 @@ class ICMPPing(NetworkApplication):
         # 3. Insert checksum into packet
         # 4. Send packet using socket
         # 5. Record time of sending
-
-
-        #Dummy header.
-        mychecksum = 0
-
-
-        #Creating dummy ICMP header
-        #struct -- Interpret strings as packed binary data.
-        header = struct.pack("bbHHh", ICMP_ECHO, 0, mychecksum, ID, 1)
-
-        data = struct.pack("d",time.time())
-
-
-        #Calculating the checksum for dummy header.
-        mychecksum = self.checksum(header + data)
-
-        #htons -- stores the bytes in the right order.
-        mychecksum = socket.htons(mychecksum) 
-
-        #Creating the packet using the header and data.
-        header = struct.pack("bbHHh", ICMP_ECHO, 0, mychecksum, ID, 1)
-        packet = header + data
-
-        #Sending the packet.
-        icmpSocket.sendto(packet,(destinationAddress,0))
-
-        #Recording the time of sending so it can be used in another method.
-        sendTime = time.time() 
-        return sendTime 
-
-        pass
+        #The session keeps one echo request and only patches the sequence number, timestamp and checksum.
+        return icmpSocket.send(destinationAddress, ID)
 
     def doOnePing(self, destinationAddress, timeout = 4):
         # 1. Create ICMP socket
@@ -195,269 +706,825 @@ class ICMPPing(NetworkApplication):
         # 3. Call receiveOnePing function
         # 4. Close ICMP socket
         # 5. Return total network delay
+        #The socket is opened on the first ping and kept for the ones after it.
+        if getattr(self, 'session', None) is None:
+            self.session = ICMPProbeSession()
+            self.sequence = 0
+        self.sequence = (self.sequence + 1) & 0xFFFF
+
+        time_Sent = self.sendOnePing(self.session, destinationAddress, self.sequence)
+        if time_Sent is None:
+            return None
+        return self.receiveOnePing(self.session, destinationAddress, time_Sent, self.sequence, timeout)
+
+    def pingContinuously(self, destination, count, interval, timeout, flood=False):
+        #Keeps probes in flight on one socket, so intervals shorter than the round trip work, and folds
+        #every reply into a PingStatistics so memory stays constant however long it runs.
+        session = ICMPProbeSession()
+        statistics = PingStatistics()
+        #sequence -> send time, oldest first so timeouts are found at the front.
+        pending = collections.OrderedDict()
+        sequence = 0
+        nextSend = time.monotonic()
+        try:
+            while count is None or statistics.transmitted < count or pending:
+                now = time.monotonic()
+                while pending and next(iter(pending.values())) + timeout <= now:
+                    lostSequence, time_Sent = pending.popitem(last=False)
+                    if self.recorder is not None:
+                        self.recorder.append(time_Sent, destination, None, lostSequence, 0, PROBE_LOST, None)
+                    if not flood:
+                        print("Request timeout for icmp_seq %d" % (lostSequence))
+
+                moreToSend = count is None or statistics.transmitted < count
+                if moreToSend and now >= nextSend:
+                    time_Sent = session.send(destination, sequence)
+                    #If it couldn't even be sent it just counts as lost.
+                    if time_Sent is not None:
+                        pending[sequence] = time_Sent
+                    statistics.transmitted += 1
+                    sequence = (sequence + 1) & 0xFFFF
+                    nextSend = now + interval
+                    if flood:
+                        print('.', end='', flush=True)
+                    continue
+
+                #Sleep until a reply arrives, the next probe is due or the oldest one times out.
+                wakeups = [next(iter(pending.values())) + timeout] if pending else []
+                if moreToSend:
+                    wakeups.append(nextSend)
+                if not wakeups:
+                    break
+                received = session.receive(min(wakeups))
+                if received is None:
+                    continue
+                receivedPacket, address, timeofArrival = received
+
+                reply = self.parseICMPReply(receivedPacket)
+                if reply is None or reply[0] != ICMP_ECHO_REPLY or reply[2] != session.identifier or reply[3] not in pending:
+                    continue
+                time_Sent = pending.pop(reply[3])
+                delay = (timeofArrival - time_Sent) * 1000
+                statistics.add(delay)
+                if self.recorder is not None:
+                    self.recorder.append(time_Sent, destination, address[0], reply[3], 0, ICMP_ECHO_REPLY, delay)
+                if flood:
+                    #Rub out the dot for this probe and send the next one straight away.
+                    print('\b \b', end='', flush=True)
+                    nextSend = timeofArrival
+                else:
+                    ipHeaderLength = (receivedPacket[0] & 0x0F) * 4
+                    self.printOneResult(address[0], len(receivedPacket) - ipHeaderLength, delay, receivedPacket[8])
+
+        except KeyboardInterrupt:
+            pass
+        finally:
+            session.close()
+            if flood:
+                print()
+
+        return statistics
+
+    def expandTargets(self, names):
+        #Resolves hostnames and CIDR ranges into a list of IPv4 addresses without duplicates.
+        addresses = []
+        for name in names:
+            if '/' in name:
+                network = ipaddress.ip_network(name, strict=False)
+                hosts = list(network.hosts()) or [network.network_address]
+                addresses.extend(str(host) for host in hosts)
+            else:
+                addresses.append(socket.gethostbyname(name))
+        return list(dict.fromkeys(addresses))
+
+    def receiveSweepReplies(self, session, pending, results, deadline):
+        #Matches echo replies to outstanding probes by (source address, sequence number) until the
+        #deadline passes or nothing is left in flight. A zero deadline just drains what has arrived.
+        while pending:
+            received = session.receive(deadline)
+            if received is None:
+                return
+            receivedPacket, address, timeofArrival = received
+
+            reply = self.parseICMPReply(receivedPacket)
+            if reply is None or reply[0] != ICMP_ECHO_REPLY or reply[2] != session.identifier:
+                continue
+            sequence = reply[3]
+
+            time_Sent = pending.pop((address[0], sequence), None)
+            if time_Sent is not None:
+                delay = (timeofArrival - time_Sent) * 1000
+                results[address[0]].append(delay)
+                if self.recorder is not None:
+                    self.recorder.append(time_Sent, address[0], address[0], sequence, 0, ICMP_ECHO_REPLY, delay)
+
+    def sweep(self, names, timeout, count):
+        # 1. Expand the hosts and ranges into addresses
+        # 2. Send every probe from one raw socket without waiting for replies
+        # 3. Match replies to probes by ICMP identifier and sequence number
+        # 4. Wait one timeout after the last probe for stragglers
+        # 5. Print which hosts are alive
+        targets = self.expandTargets(names)
+        print('Sweeping %d hosts...' % (len(targets)))
+
+        #Large sweeps get a burst of replies at once, the session's receive buffer makes room for them.
+        session = ICMPProbeSession()
+        pending = {}
+        results = {address: [] for address in targets}
+        sent = collections.Counter()
+        sequence = 0
+        try:
+            for round in range(count):
+                for address in targets:
+                    sent[address] += 1
+                    time_Sent = session.send(address, sequence)
+                    if time_Sent is None:
+                        #Unroutable or broadcast address, it just counts as lost.
+                        continue
+                    pending[(address, sequence)] = time_Sent
+                    sequence = (sequence + 1) & 0xFFFF
+                    #Pick up early replies so they don't overflow the socket buffer.
+                    self.receiveSweepReplies(session, pending, results, 0)
+
+            self.receiveSweepReplies(session, pending, results, time.monotonic() + timeout)
+        finally:
+            session.close()
+
+        if self.recorder is not None:
+            for (address, sequence), time_Sent in pending.items():
+                self.recorder.append(time_Sent, address, None, sequence, 0, PROBE_LOST, None)
+
+        alive = 0
+        for address in targets:
+            delays = results[address]
+            if not delays:
+                print("%s is unreachable" % (address))
+                continue
+            alive += 1
+            if count == 1:
+                print("%s is alive (%.2f ms)" % (address, delays[0]))
+            else:
+                loss = 100.0 * (sent[address] - len(delays)) / sent[address]
+                print("%s : xmt/rcv/%%loss = %d/%d/%.0f%%, min/avg/max = %.2f/%.2f/%.2f ms" % (
+                    address, sent[address], len(delays), loss,
+                    min(delays), sum(delays) / len(delays), max(delays)))
+        print("%d/%d hosts alive" % (alive, len(targets)))
 
-        #Create ICMP socket.
-        icmp = socket.getprotobyname("icmp")
-
-        #Create socket.
-        icmpSocket = socket.socket(socket.AF_INET,socket.SOCK_RAW, icmp)
-
-   
-        #Here is where all the functions are called so we can workout the total delay.
-        time_Sent = self.sendOnePing(icmpSocket,destinationAddress,ID)
-        delay = self.receiveOnePing(icmpSocket,ID,time_Sent,timeout,destinationAddress)
-        icmpSocket.close()
-
-        return delay
+    def __init__(self, args):
+        self.recorder = None
+        if args.record:
+            try:
+                self.recorder = ProbeRecordFile(args.record, args.record_capacity)
+            except (OSError, ValueError) as error:
+                print("Error: %s" % (error))
+                return
+        try:
+            if args.sweep or args.hosts or '/' in args.hostname:
+                try:
+                    self.sweep([args.hostname] + args.hosts, args.timeout, args.count or 1)
+                except (socket.gaierror, ValueError) as error:
+                    print("Error: %s" % (error))
+                return
 
-        pass
+            print('Ping to: %s...' % (args.hostname))
+            try:
+                # 1. Look up hostname, resolving it to an IP address
+                destination = socket.gethostbyname(args.hostname)
+            except socket.gaierror:
+                print("Error")
+                return
+            # 2. Send a probe every interval, or as fast as replies come back in flood mode
+            # 3. Print out the returned delay (and other relevant details) using the printOneResult method
+            # 4. Continue this process until stopped, or until --count probes have been answered or timed out
+            interval = FLOOD_INTERVAL if args.flood else args.interval
+            statistics = self.pingContinuously(destination, args.count, interval, args.timeout, args.flood)
+
+            print("--- %s ping statistics ---" % (args.hostname))
+            print("%d packets transmitted, %d received" % (statistics.transmitted, statistics.received))
+            if statistics.received:
+                self.printAdditionalDetails(statistics.loss(), statistics.minimum, statistics.mean,
+                                            statistics.maximum, statistics.deviation())
+                print("rtt p50/p95/p99 = %.2f/%.2f/%.2f ms" % (statistics.percentile(50),
+                                                              statistics.percentile(95),
+                                                              statistics.percentile(99)))
+            else:
+                self.printAdditionalDetails(statistics.loss())
+        finally:
+            if self.recorder is not None:
+                self.recorder.close()
+
+
+class HostnameResolver:
+    #Reverse DNS lookups run on a thread pool and are cached by address for DNS_CACHE_TTL seconds.
+
+    def __init__(self, workers=8, ttl=DNS_CACHE_TTL, maxEntries=4096):
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self.ttl = ttl
+        self.maxEntries = maxEntries
+        #address -> (expiry time, future resolving to the name or None)
+        self.cache = collections.OrderedDict()
+
+    def lookupName(self, address):
+        try:
+            return socket.gethostbyaddr(address)[0]
+        except (socket.herror, socket.gaierror, OSError):
+            return None
+
+    def lookup(self, address):
+        #Starts resolving address in the background if it isn't cached, returning its future.
+        now = time.monotonic()
+        cached = self.cache.get(address)
+        if cached is not None and cached[0] > now:
+            self.cache.move_to_end(address)
+            return cached[1]
+
+        future = self.executor.submit(self.lookupName, address)
+        self.cache[address] = (now + self.ttl, future)
+        self.cache.move_to_end(address)
+        while len(self.cache) > self.maxEntries:
+            self.cache.popitem(last=False)
+        return future
+
+    def resolve(self, address, deadline=None):
+        #Name for address, or the address itself if it has none or isn't resolved by the monotonic deadline.
+        #Callers resolving several addresses pass one deadline so a stalled resolver costs DNS_TIMEOUT once, not per address.
+        if deadline is None:
+            deadline = time.monotonic() + DNS_TIMEOUT
+        try:
+            return self.lookup(address).result(max(0, deadline - time.monotonic())) or address
+        except concurrent.futures.TimeoutError:
+            return address
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class Traceroute(NetworkApplication):
+    #Paris traceroute: every probe of a flow keeps the header fields per-flow load balancers hash on the
+    #same, so the whole flow follows one path. ICMP probes keep a fixed checksum by adjusting a payload word
+    #and are told apart by sequence number. UDP probes keep fixed ports and are told apart by their
+    #checksum, which a payload word sets. Several flows can take different equal-cost paths, which is
+    #how the branches of a multipath route are found.
+
+    def onesComplementSum(self, data):
+        #16-bit one's complement sum of big-endian words with the carries folded back in.
+        csum = sum(struct.unpack('!%dH' % (len(data) // 2), data))
+        while csum >> 16:
+            csum = (csum >> 16) + (csum & 0xffff)
+        return csum
+
+    def compensationWord(self, partialSum, checksum):
+        #The word that, appended to data summing to partialSum, makes the data's checksum come out as checksum.
+        word = (~checksum & 0xffff) + (~partialSum & 0xffff)
+        while word >> 16:
+            word = (word >> 16) + (word & 0xffff)
+        return word
+
+    def buildICMPProbe(self, identifier, sequence, checksum):
+        header = struct.pack('!BBHHH', ICMP_ECHO, 0, 0, identifier, sequence)
+        word = self.compensationWord(self.onesComplementSum(header), checksum)
+        return struct.pack('!BBHHHH', ICMP_ECHO, 0, checksum, identifier, sequence, word)
+
+    def buildUDPProbe(self, source, destination, sourcePort, checksum):
+        #UDP header and a payload word chosen to make the checksum valid. The checksum also covers a pseudo
+        #header of the addresses, protocol and length, which is why the source address is needed.
+        length = 8 + 2
+        pseudoHeader = socket.inet_aton(source) + socket.inet_aton(destination) + struct.pack(
+            '!BBH', 0, socket.IPPROTO_UDP, length)
+        header = struct.pack('!HHHH', sourcePort, TRACEROUTE_PORT, length, 0)
+        word = self.compensationWord(self.onesComplementSum(pseudoHeader + header), checksum)
+        return struct.pack('!HHHHH', sourcePort, TRACEROUTE_PORT, length, checksum, word)
+
+    def sourceAddress(self, destination):
+        #The address the kernel will send from, for the UDP pseudo header. Connecting a UDP socket sends nothing.
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as routeSocket:
+            routeSocket.connect((destination, TRACEROUTE_PORT))
+            return routeSocket.getsockname()[0]
+
+    def sendUDPProbe(self, udpSocket, packet, destination, ttl):
+        udpSocket.setsockopt(socket.IPPROTO_IP, socket.IP_TTL, ttl)
+        time_Sent = time.monotonic()
+        try:
+            udpSocket.sendto(packet, (destination, 0))
+        except OSError:
+            return None
+        return time_Sent
+
+    def receiveTraceReplies(self, session, destination, protocol, pending, hops, destinationTTLs, deadline):
+        #Records replies against their probes until the deadline, noting in destinationTTLs the lowest TTL
+        #the destination answered at on each flow. A zero deadline just drains what has already arrived.
+        while pending:
+            #Nothing past the destination will ever answer, so only wait on the hops before it.
+            if destinationTTLs and all(flowID in destinationTTLs and ttl > destinationTTLs[flowID]
+                                       for flowID, ttl, query, sequence, sent in pending.values()):
+                break
+            received = session.receive(deadline)
+            if received is None:
+                break
+            receivedPacket, address, timeofArrival = received
+
+            reply = self.parseProbeReply(receivedPacket)
+            if reply is None:
+                continue
+            type, code, quotedProtocol, quotedDestination, header = reply
+            if quotedDestination not in (None, destination):
+                continue
+            #The same header bytes the probe was keyed on when it was sent.
+            if protocol == 'udp' and quotedProtocol == socket.IPPROTO_UDP:
+                key = bytes(header[0:2]) + bytes(header[6:8])
+            elif protocol == 'icmp' and quotedProtocol == socket.IPPROTO_ICMP:
+                key = bytes(header[4:8])
+            else:
+                continue
+            probe = pending.pop(key, None)
+            if probe is None:
+                continue
+
+            flowID, ttl, query, sequence, time_Sent = probe
+            delay = (timeofArrival - time_Sent) * 1000
+            hops[flowID][ttl][query] = (address[0], delay)
+            if self.recorder is not None:
+                self.recorder.append(time_Sent, destination, address[0], sequence, ttl, type, delay)
+            #Start the name lookup now so it runs while we keep measuring.
+            if self.resolver is not None:
+                self.resolver.lookup(address[0])
+            if type == ICMP_ECHO_REPLY or (type == ICMP_DEST_UNREACHABLE and address[0] == destination):
+                if ttl < destinationTTLs.get(flowID, ttl + 1):
+                    destinationTTLs[flowID] = ttl
+
+    def traceFlows(self, destination, protocol, flowIDs, maxHops, queries, timeout):
+        # 1. Give every flow its identifier: a fixed ICMP checksum or a fixed UDP source port
+        # 2. Send every probe of every flow for every TTL straight away
+        # 3. Match each Time Exceeded, Port Unreachable or Echo Reply to its probe through the quoted header
+        # 4. Stop once every flow has heard from each hop up to the destination, or the timeout runs out
+        # Returns {flowID: {ttl: [(address, delay in ms) or None for each query]}} and
+        # {flowID: TTL the destination answered at}.
+        session = ICMPProbeSession()
+        #Identifying probe header bytes -> (flowID, ttl, query, sequence, send time).
+        pending = {}
+        hops = {flowID: {ttl: [None] * queries for ttl in range(1, maxHops + 1)} for flowID in flowIDs}
+        destinationTTLs = {}
+        udpSocket = None
+        try:
+            if protocol == 'udp':
+                #Raw, so the kernel (or the NIC) never rewrites the checksum the probe is identified by.
+                udpSocket = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_UDP)
+                source = self.sourceAddress(destination)
+            for flowIndex, flowID in enumerate(flowIDs):
+                #A fixed port per flow ID means the same flow takes the same path on every run.
+                sourcePort = TRACEROUTE_SOURCE_PORT + flowID
+                for ttl in range(1, maxHops + 1):
+                    for query in range(queries):
+                        sequence = (flowIndex * maxHops + ttl - 1) * queries + query
+                        if protocol == 'udp':
+                            #The checksum is never 0, which would mean no checksum at all.
+                            packet = self.buildUDPProbe(source, destination, sourcePort, sequence + 1)
+                            key = struct.pack('!HH', sourcePort, sequence + 1)
+                            time_Sent = self.sendUDPProbe(udpSocket, packet, destination, ttl)
+                        else:
+                            packet = self.buildICMPProbe(session.identifier, sequence, PARIS_ICMP_CHECKSUM + flowID)
+                            key = struct.pack('!HH', session.identifier, sequence)
+                            time_Sent = session.sendPacket(destination, packet, ttl)
+                        if time_Sent is None:
+                            continue
+                        pending[key] = (flowID, ttl, query, sequence, time_Sent)
+                        #Pick up early replies so the socket buffer never overflows during the burst.
+                        self.receiveTraceReplies(session, destination, protocol, pending, hops, destinationTTLs, 0)
+
+            self.receiveTraceReplies(session, destination, protocol, pending, hops, destinationTTLs,
+                                     time.monotonic() + timeout)
+        finally:
+            session.close()
+            if udpSocket is not None:
+                udpSocket.close()
+
+        if self.recorder is not None:
+            #Probes past the destination were never going to be answered, so they aren't losses.
+            for flowID, ttl, query, sequence, time_Sent in pending.values():
+                if ttl <= destinationTTLs.get(flowID, maxHops):
+                    self.recorder.append(time_Sent, destination, None, sequence, ttl, PROBE_LOST, None)
+
+        return hops, destinationTTLs
+
+    def hopName(self, address):
+        if self.resolver is None:
+            return address
+        return "%s (%s)" % (self.resolver.resolve(address, self.namesDeadline), address)
+
+    def printHop(self, ttl, results):
+        line = "%2d " % (ttl)
+        lastAddress = None
+        for result in results:
+            if result is None:
+                line += "  *"
+                continue
+            address, delay = result
+            if address != lastAddress:
+                line += "  %s" % (self.hopName(address))
+                lastAddress = address
+            line += "  %.2f ms" % (delay)
+        print(line)
+
+    def printInterfaces(self, ttl, flowResults):
+        #Each address that answered at this TTL, once, with its lowest RTT and how many flows went through it.
+        #flowResults holds the query results of every flow that hadn't already reached the destination.
+        interfaces = {}
+        for results in flowResults:
+            for address in {result[0] for result in results if result is not None}:
+                interfaces[address] = interfaces.get(address, 0) + 1
+        if not interfaces:
+            print("%2d   *" % (ttl))
+            return
+
+        lines = []
+        for address in sorted(interfaces, key=socket.inet_aton):
+            delay = min(result[1] for results in flowResults for result in results
+                        if result is not None and result[0] == address)
+            lines.append("%s  %.2f ms  [%d/%d flows]" % (self.hopName(address), delay, interfaces[address],
+                                                         len(flowResults)))
+        print("%2d   %s" % (ttl, "\n     ".join(lines)))
 
     def __init__(self, args):
-        lostpacket = 0
-        totalpackets = 0
-        packetloss = 0
-        delays = []
-        sumofdelays = None
-        print('Ping to: %s...' % (args.hostname))
-        try:
-            # 1. Look up hostname, resolving it to an IP address
-            destination = socket.gethostbyname(args.hostname)
-            # 2. Call doOnePing function, approximately every second
-            for x in range(5):
-                delay = self.doOnePing(destination,timeout = 1)
-                #Multiplying by 1000 so we can see the answer in ms.
-                delay = delay * 1000
-                time.sleep(1)
-                if delay:
-                #Using the print one result with the IP, packet length (size), delay (in ms), and a static of ttl = 200.
-                    self.printOneResult(destination,8,delay,200) 
-                    totalpackets = totalpackets + 1
-                    delays.insert(x,delay)
-                if delay > 100.0:
-                    print("packet lost")
-                    lostpacket = lostpacket + 1
+        print('Traceroute to: %s...' % (args.hostname))
+        try:
+            ip = socket.gethostbyname(args.hostname)
         except socket.gaierror:
-            print("Error")
-        packetloss = (lostpacket / totalpackets)* 100
-        sumofdelays = sum(delays)
-        averageDelay = sumofdelays / len(delays) 
-        self.printAdditionalDetails(packetloss,min(delays),max(delays),averageDelay)
-        # 3. Print out the returned delay (and other relevant details) using the printOneResult method
-        # 4. Continue this process until stopped
-        
-            
-
-
-class Traceroute(NetworkApplication):  
-
-    def receiveOnePing(self, icmpSocket, destinationAddress,time_Sent, ID, timeout):
-        # 1. Wait for the socket to receive a reply
-        # 2. Once received, record time of receipt, otherwise, handle a timeout
-        # 3. Compare the time of receipt to time of sending, producing the total network delay
-        # 4. Unpack the packet header for useful information, including the ID
-        # 5. Check that the ID matches between the request and reply
-        # 6. Return total network delay
-
-        #timeLft = Time remaining till timeout
-        timeLft = timeout
-
-        #Start waiting for socket to send a reply back
-        
-        while True:          
-
-            #Header we are unpacking
-            receivedPacket, address = icmpSocket.recvfrom(1024)
-            icmpHeader = receivedPacket[20:28]
-            timeofArrival = time.time()
-
-
-            #Picking exactly what we need from the header and assining it to variables.
-            type, code, checksum, packetID, sequence = struct.unpack("bbHHh", icmpHeader)
-
-            
-
-            
-
-            #Packet ID matches?
-            if ID == packetID:
-                
-                #Assigning the size of the packet in bytes to a variable so I can find the sieze of it for debugging.
-                #bytesInD = struct.calcsize("d")
-                #print(bytesInD," Size of packet")
-
-
-                #Measuring total network delay.
-                totalnetDelay = timeofArrival - time_Sent
-
-                
-                return totalnetDelay
-            else: 
-                print("The ID's don't match")
-
-                timeLft = timeofArrival - time_Sent
+            print("Incorrect host")
+            return
+
+        protocol = args.protocol.lower()
+        maxHops = max(1, min(args.max_hops, MAX_HOPS))
+        flowIDs = list(range(args.flow_id, args.flow_id + max(1, args.flows)))
+        if protocol not in ('icmp', 'udp'):
+            print("Protocol must be ICMP or UDP")
+            return
+        if args.flow_id < 0 or flowIDs[-1] >= MAX_FLOWS or len(flowIDs) * maxHops * args.queries >= 0xFFFF:
+            print("Too many probes: flow IDs must stay below %d and flows x hops x queries below 65535" % (MAX_FLOWS))
+            return
+
+        self.recorder = None
+        if args.record:
+            try:
+                self.recorder = ProbeRecordFile(args.record, args.record_capacity)
+            except (OSError, ValueError) as error:
+                print("Error: %s" % (error))
+                return
 
-                if timeLft <= 0:
+        #Names are looked up on other threads, so DNS never ends up in the timings.
+        self.resolver = None if args.numeric else HostnameResolver()
+        try:
+            hops, destinationTTLs = self.traceFlows(ip, protocol, flowIDs, maxHops, args.queries, args.timeout)
+            #Lookups started as replies came in, all of them share what is left of DNS_TIMEOUT from here.
+            self.namesDeadline = time.monotonic() + DNS_TIMEOUT
+            if len(flowIDs) == 1:
+                for ttl in range(1, destinationTTLs.get(flowIDs[0], maxHops) + 1):
+                    self.printHop(ttl, hops[flowIDs[0]][ttl])
+            else:
+                #Flows that reached the destination early stop contributing to the hops after it.
+                lastTTL = max(destinationTTLs.values()) if len(destinationTTLs) == len(flowIDs) else maxHops
+                for ttl in range(1, lastTTL + 1):
+                    self.printInterfaces(ttl, [hops[flowID][ttl] for flowID in flowIDs
+                                               if ttl <= destinationTTLs.get(flowID, maxHops)])
+        finally:
+            if self.resolver is not None:
+                self.resolver.close()
+            if self.recorder is not None:
+                self.recorder.close()
+
+
+class ProbeRecords(NetworkApplication):
+    #Reads a ring file written by ping or traceroute --record, streaming it or summarising each target and TTL.
+
+    def printRecord(self, record):
+        timestamp, target, responder, sequence, ttl, icmpType, delay = record
+        when = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp)) + '.%03d' % (timestamp % 1 * 1000)
+        if delay is None:
+            print('%s  %s  ttl=%d icmp_seq=%d  lost' % (when, target, ttl, sequence))
+        else:
+            print('%s  %s  ttl=%d icmp_seq=%d  from %s type=%d  %.3f ms' % (when, target, ttl, sequence,
+                                                                          responder, icmpType, delay))
+
+    def printSummary(self, records):
+        #One PingStatistics per (target, TTL), so memory depends on how many paths were probed, not on the file.
+        groups = {}
+        for timestamp, target, responder, sequence, ttl, icmpType, delay in records:
+            group = groups.get((target, ttl))
+            if group is None:
+                group = groups[(target, ttl)] = [PingStatistics(), set(), timestamp, timestamp]
+            statistics, responders = group[0], group[1]
+            statistics.transmitted += 1
+            group[3] = timestamp
+            if delay is not None:
+                statistics.add(delay)
+                responders.add(responder)
+
+        for (target, ttl), (statistics, responders, first, last) in sorted(
+                groups.items(), key=lambda item: (socket.inet_aton(item[0][0]), item[0][1])):
+            print('%s ttl=%d: %d probes from %s to %s, %.1f%% loss' % (
+                target, ttl, statistics.transmitted, time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(first)),
+                time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(last)), statistics.loss()))
+            if statistics.received:
+                print('    rtt min/avg/max/mdev = %.2f/%.2f/%.2f/%.2f ms, p50/p95/p99 = %.2f/%.2f/%.2f ms' % (
+                    statistics.minimum, statistics.mean, statistics.maximum, statistics.deviation(),
+                    statistics.percentile(50), statistics.percentile(95), statistics.percentile(99)))
+                print('    answered by %s' % (', '.join(sorted(responders, key=socket.inet_aton))))
 
-                    return
-                    
+    def __init__(self, args):
+        try:
+            recordFile = ProbeRecordFile(args.file, writable=False)
+        except (OSError, ValueError) as error:
+            print("Error: %s" % (error))
+            return
+
+        with recordFile:
+            records = recordFile.records()
+            if args.target:
+                records = (record for record in records if record[1] == args.target)
+            if args.since:
+                since = time.time() - args.since
+                records = (record for record in records if record[0] >= since)
+            try:
+                if args.summary:
+                    self.printSummary(records)
+                else:
+                    for record in records:
+                        self.printRecord(record)
+            except BrokenPipeError:
+                #Piped into head or similar.
                 pass
 
-    def sendOnePing(self, icmpSocket, destinationAddress, ID):
-        # 1. Build ICMP header
-        # 2. Checksum ICMP packet using given function
-        # 3. Insert checksum into packet
-        # 4. Send packet using socket
-        # 5. Record time of sending
-
-
-        #Dummy header.
-        mychecksum = 0
-
 
-        #Creating dummy ICMP header
-        #struct -- Interpret strings as packed binary data.
-        header = struct.pack("bbHHh", ICMP_ECHO, 0, mychecksum, ID, 1)
-
-        data = struct.pack("d",time.time())
-
-
-        #Calculating the checksum for dummy header.
-        mychecksum = self.checksum(header + data)
-
-        #htons -- stores the bytes in the right order.
-        mychecksum = socket.htons(mychecksum) 
-
-        #Creating the packet using the header and data.
-        header = struct.pack("bbHHh", ICMP_ECHO, 0, mychecksum, ID, 1)
-        packet = header + data
-
-        #Sending the packet.
-        icmpSocket.sendto(packet,(destinationAddress,0))
-
-        #Recording the time of sending so it can be used in another method.
-        sendTime = time.time() 
-        return sendTime 
-
-
-    def doOnePing(self, destinationAddress, timeout = 4):
-        # 1. Create ICMP socket
-        # 2. Call sendOnePing function
-        # 3. Call receiveOnePing function
-        # 4. Close ICMP socket
-        # 5. Return total network delay
+class MetricHistogram:
+    #Prometheus style latency histogram in seconds. Buckets are allocated once so observing a value only
+    #bumps a counter, the cumulative counts Prometheus wants are worked out when it is rendered.
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self.buckets = [0] * (len(METRIC_BUCKET_BOUNDS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.buckets[bisect.bisect_left(METRIC_BUCKET_BOUNDS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def render(self, lines):
+        lines.append('# HELP %s %s' % (self.name, self.description))
+        lines.append('# TYPE %s histogram' % (self.name))
+        cumulative = 0
+        for bound, bucketCount in zip(METRIC_BUCKET_BOUNDS, self.buckets):
+            cumulative += bucketCount
+            lines.append('%s_bucket{le="%g"} %d' % (self.name, bound, cumulative))
+        lines.append('%s_bucket{le="+Inf"} %d' % (self.name, self.count))
+        lines.append('%s_sum %.9f' % (self.name, self.sum))
+        lines.append('%s_count %d' % (self.name, self.count))
+
+
+class ServerMetrics:
+    #Counters and latency histograms for one server process, served in the Prometheus text format.
+    #With several web workers each process keeps, and answers /__metrics with, its own numbers.
+
+    def __init__(self, prefix, counters, histograms):
+        #counters and histograms map each metric's short name to its help text.
+        self.prefix = prefix
+        self.counterDescriptions = counters
+        self.counters = dict.fromkeys(counters, 0)
+        self.histograms = {name: MetricHistogram('%s_%s_seconds' % (prefix, name), description)
+                           for name, description in histograms.items()}
+        #Status code (as bytes from the status line) -> responses sent with it.
+        self.responses = {}
+
+        #Totals at the last stats line, so it can show rates and means over the interval.
+        self.lastStats = time.monotonic()
+        self.lastCounters = dict(self.counters)
+        self.lastHistograms = {name: (0, 0.0) for name in self.histograms}
+
+    def countResponse(self, status):
+        self.responses[status] = self.responses.get(status, 0) + 1
+
+    def render(self, gauges):
+        #gauges maps names to (help text, current value) and is sampled by the caller.
+        lines = []
+        for name, description in self.counterDescriptions.items():
+            metric = '%s_%s_total' % (self.prefix, name)
+            lines.append('# HELP %s %s' % (metric, description))
+            lines.append('# TYPE %s counter' % (metric))
+            lines.append('%s %d' % (metric, self.counters[name]))
+        if self.responses:
+            metric = '%s_responses_total' % (self.prefix)
+            lines.append('# HELP %s Responses sent by status code.' % (metric))
+            lines.append('# TYPE %s counter' % (metric))
+            for status, count in sorted(self.responses.items()):
+                lines.append('%s{code="%s"} %d' % (metric, status.decode('latin-1'), count))
+        for name, (description, value) in gauges.items():
+            metric = '%s_%s' % (self.prefix, name)
+            lines.append('# HELP %s %s' % (metric, description))
+            lines.append('# TYPE %s gauge' % (metric))
+            lines.append('%s %d' % (metric, value))
+        for histogram in self.histograms.values():
+            histogram.render(lines)
+        return ('\n'.join(lines) + '\n').encode()
+
+    def statsLine(self, gauges):
+        #One line summary: counter totals with their rate, gauges, and mean latencies since the last line.
+        now = time.monotonic()
+        elapsed = max(now - self.lastStats, 1e-9)
+        self.lastStats = now
+        fields = [self.prefix]
+        for name, value in self.counters.items():
+            fields.append('%s=%d (%.1f/s)' % (name, value, (value - self.lastCounters[name]) / elapsed))
+            self.lastCounters[name] = value
+        for name, (description, value) in gauges.items():
+            fields.append('%s=%d' % (name, value))
+        for name, histogram in self.histograms.items():
+            lastCount, lastSum = self.lastHistograms[name]
+            count = histogram.count - lastCount
+            fields.append('%s=%.3fms' % (name, (histogram.sum - lastSum) / count * 1000 if count else 0.0))
+            self.lastHistograms[name] = (histogram.count, histogram.sum)
+        return ' '.join(fields)
+
+
+class WebConnection:
+    #Per-connection state kept by the WebServer event loop.
+
+    def __init__(self, tcpSocket, address):
+        self.tcpSocket = tcpSocket
+        self.address = address
+        #Bytes received but not yet parsed into a request, reused for every request on the connection.
+        self.inBuffer = bytearray()
+        #How much of inBuffer has already been searched for the blank line ending the request head.
+        self.scanned = 0
+        #Bytes of the last request's body still to arrive, they are thrown away unread.
+        self.discardRemaining = 0
+        #Response pieces still waiting to be written: memoryviews of bytes or FileSegments.
+        self.outQueue = collections.deque()
+        self.closeAfterSend = False
+        self.closed = False
+        self.events = selectors.EVENT_READ
+        self.requestCount = 0
+        self.lastActive = time.monotonic()
+        #perf_counter() when the response being written was queued, for the send latency histogram.
+        self.sendStarted = None
+
+
+class FileSegment:
+    #A byte range of an open file queued for sending with sendfile.
+    #closeFile is False for all but the last of several ranges sent from the same file.
+
+    def __init__(self, fileObject, offset, count, closeFile=True):
+        self.fileObject = fileObject
+        self.offset = offset
+        self.remaining = count
+        self.closeFile = closeFile
+
+    def close(self):
+        if self.closeFile:
+            self.fileObject.close()
+
+
+class StaticFile:
+    #Validators and precomputed response headers for one version of a file on disk.
+
+    def __init__(self, file_Name, fileStat, body=None, encoding=None, size=None):
+        #encoding is set for gzip variants, whose size differs from the file they were made from.
+        self.fileStat = fileStat
+        self.version = (fileStat.st_mtime_ns, fileStat.st_size)
+        self.size = fileStat.st_size if size is None else size
+        self.mtime = int(fileStat.st_mtime)
+        #Contents are only held when the file is kept in the StaticFileCache.
+        self.body = body
+        self.encoding = encoding
+        self.checkedAt = time.monotonic()
+        #When WebServer.gzipVariant should next look for a .gz next to the file.
+        self.gzipSiblingCheckDue = 0.0
+
+        self.etag = '"%x-%x"' % self.version
+        if encoding is not None:
+            #Each encoding is a different representation so it needs its own validator.
+            self.etag = '"%x-%x-%s"' % (self.version + (encoding,))
+        self.lastModified = email.utils.formatdate(fileStat.st_mtime, usegmt=True)
+        content_Type, file_Encoding = mimetypes.guess_type(file_Name)
+        if file_Encoding is not None:
+            #page.html.gz asked for by name is a gzip file, not HTML, since it goes out without Content-Encoding.
+            content_Type = ENCODED_FILE_TYPES.get(file_Encoding)
+        content_Type = content_Type or 'application/octet-stream'
+        self.contentType = content_Type
+        self.compressible = content_Type.startswith(COMPRESSIBLE_TYPES)
+        validators = "ETag: %s\r\nLast-Modified: %s\r\n" % (self.etag, self.lastModified)
+        if self.compressible:
+            validators += "Vary: Accept-Encoding\r\n"
+        if encoding is not None:
+            validators += "Content-Encoding: %s\r\n" % (encoding)
+        self.validators = validators
+        self.okHeader = ("HTTP/1.1 200 OK\r\nContent-Type: %s\r\nContent-Length: %d\r\nAccept-Ranges: bytes\r\n%s"
+                         % (content_Type, self.size, validators)).encode()
+        self.notModifiedHeader = ("HTTP/1.1 304 Not Modified\r\n%s" % validators).encode()
+
+    def partialHeader(self, start, end):
+        #Header for a 206 carrying the single inclusive byte range start-end.
+        return ("HTTP/1.1 206 Partial Content\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d\r\n"
+                "Content-Length: %d\r\n%s" % (self.contentType, start, end, self.size,
+                                              end - start + 1, self.validators)).encode()
+
+    def rangeApplies(self, headers):
+        #If-Range asks for the range only if the file still matches, otherwise the whole file is sent.
+        if 'if-range' not in headers:
+            return True
+        ifRange = headers['if-range'].strip()
+        if ifRange.startswith('W/'):
+            #Weak validators can't be used for ranges.
+            return False
+        if ifRange.startswith('"'):
+            return ifRange == self.etag
+        return ifRange == self.lastModified
+
+    def isNotModified(self, headers):
+        #If-None-Match wins over If-Modified-Since when a client sends both.
+        if 'if-none-match' in headers:
+            for tag in headers['if-none-match'].split(','):
+                tag = tag.strip()
+                if tag == '*' or tag.replace('W/', '', 1) == self.etag:
+                    return True
+            return False
+
+        if 'if-modified-since' in headers:
+            try:
+                since = email.utils.parsedate_to_datetime(headers['if-modified-since'])
+            except (TypeError, ValueError):
+                return False
+            return self.mtime <= since.timestamp()
+
+        return False
+
+
+class StaticFileCache:
+    #Byte-budgeted LRU of hot files so repeat requests are answered without touching the disk.
+    #Keys are (path, encoding): a .gz file asked for by name and the same file sent as the gzip
+    #encoding of its uncompressed sibling get different headers, so they are different entries.
+
+    def __init__(self, maxBytes, maxFileSize, checkInterval):
+        self.maxBytes = maxBytes
+        self.maxFileSize = maxFileSize
+        #How long a cached file is trusted before its mtime and size are checked again.
+        self.checkInterval = checkInterval
+        self.entries = collections.OrderedDict()
+        self.totalBytes = 0
+
+    def get(self, key):
+        staticFile = self.entries.get(key)
+        if staticFile is None:
+            return None
+
+        now = time.monotonic()
+        if now - staticFile.checkedAt >= self.checkInterval:
+            try:
+                fileStat = os.stat(key[0])
+            except OSError:
+                self.remove(key)
+                return None
+            if (fileStat.st_mtime_ns, fileStat.st_size) != staticFile.version:
+                self.remove(key)
+                return None
+            staticFile.checkedAt = now
+
+        self.entries.move_to_end(key)
+        return staticFile
+
+    def put(self, key, staticFile):
+        if staticFile.size > self.maxBytes:
+            return
+        self.remove(key)
+        self.entries[key] = staticFile
+        self.totalBytes += staticFile.size
+        #Evict least recently used files until we are back inside the budget.
+        while self.totalBytes > self.maxBytes:
+            oldKey, oldFile = self.entries.popitem(last=False)
+            self.totalBytes -= oldFile.size
+
+    def remove(self, key):
+        staticFile = self.entries.pop(key, None)
+        if staticFile is not None:
+            self.totalBytes -= staticFile.size
+
+
+class CompressedFileCache(StaticFileCache):
+    #Gzip variants made on the fly, keyed by (path, version) so a changed file simply misses.
+
+    def __init__(self, maxBytes, maxFileSize):
+        super().__init__(maxBytes, maxFileSize, None)
+
+    def get(self, key):
+        staticFile = self.entries.get(key)
+        if staticFile is not None:
+            self.entries.move_to_end(key)
+        return staticFile
 
-        #Create ICMP socket.
-        icmp = socket.getprotobyname("icmp")
-
-        #Create socket.
-        icmpSocket = socket.socket(socket.AF_INET,socket.SOCK_RAW, icmp)
-
-   
-        #Here is where all the functions are called so we can workout the total delay.
-        time_Sent = self.sendOnePing(icmpSocket,destinationAddress,ID)
-        delay = self.receiveOnePing(icmpSocket,ID,time_Sent,timeout,destinationAddress)
-        icmpSocket.close()
-
-        return delay
-
-    pass
-
-    def single_traceroute(self,dest, ttl, timeout, time_left):
-        icmp = socket.getprotobyname("icmp")
-        raw_socket = socket.socket(socket.AF_INET, socket.SOCK_RAW, icmp)
-        raw_socket.setsockopt(socket.IPPROTO_IP, socket.IP_TTL, struct.pack('I', ttl))
-        raw_socket.settimeout(timeout)
-
-        try:
-            my_checksum = 0
-            my_id = os.getpid() & 0xFFFF  # Return the current process id
-
-            # Make a dummy header with a 0 checksum
-            header = struct.pack("BBHHH", ICMP_ECHO_REQUEST, 0, my_checksum, my_id, 1)
-            data = struct.pack("d", time.time())
-            # Calculate the checksum on the data and the dummy header.
-            my_checksum = self.checksum(header + data)
-            packet = header + data
-            raw_socket.sendto(packet, (dest, 0))
-            time_sent = time.time()
-
-            started_select = time.time()
-            what_ready = select.select([raw_socket], [], [], time_left)
-            time_in_select = time.time() - started_select
-            if what_ready[0] == []:  # Timeout
-                print("%d   Timeout: Socket not ready" % ttl)
-                return time_left - (time.time() - started_select)
-
-            time_left = time_left - time_in_select
-            if time_left <= 0:  # Timeout
-                print("%d   Timeout: No time left" % ttl)
-                return time_left
-
-            time_received = time.time()
-            rec_packet, addr = raw_socket.recvfrom(1024)
-            icmp_header = rec_packet[20:28]
-            icmp_type, code, checksum, packetID, sequence = struct.unpack(
-                "bbHHh", icmp_header)
-
-            if icmp_type == ICMP_TIME_EXCEEDED:  # TTL is 0
-                addr_name = socket.gethostbyaddr(addr[0])
-
-                print("%d   %s (%s)  %.2f ms" % (ttl, addr_name, addr[0],
-                                                (time_received - time_sent)
-                                                * 1000))
-                return time_left
-            elif icmp_type == ICMP_ECHO:  # Final destination replied
-                # Get time_sent
-                byte = struct.calcsize("d")
-                time_sent = struct.unpack("d", rec_packet[28:28 + byte])[0]
-                addr_name = socket.gethostbyaddr(addr[0])
-
-                print("%d   %s (%s)  %.2f ms" % (ttl, addr_name, addr[0],
-                                                (time_received - time_sent)
-                                                * 1000))
-                return -1
-            else:  # Handle other icmp_type
-                print("%d   icmp_type: %s   %s (%s)  %.2f ms" % (
-                ttl, icmp_type, addr_name, addr[0],
-                 (time_received - time_sent) * 1000))
-            return time_left
-        finally:  # Close socket every time
-            raw_socket.close()
-    
-            
-
-        pass
-        
-    def __init__(self, args):
-        print('Traceroute to: %s...' % (args.hostname))
-        ip = socket.gethostbyname(args.hostname)
-        type = -1
-        TTL = 0
-        ip = socket.gethostbyname(args.hostname)
-        timeout = 1
-        time_left = 1
-        try:
-            while True:
-                for i in range(1,5):
-                    TTL = TTL + 1
-                    icmp = socket.getprotobyname("icmp")
-                    icmpSocket = socket.socket(socket.AF_INET,socket.SOCK_RAW,icmp)
-                    icmpSocket.setsockopt(socket.IPPROTO_IP,socket.IP_TTL,TTL)
-                    delay = self.doOnePing(ip,timeout = 1)
-                    delay = delay * 1000
-                    current_IP = icmpSocket.recvfrom(1024)
-                    icmpHeader_IP = current_IP[20:28]
-                    time.sleep(1)
-                    #self.printOneResult(currentIP,8,delay,TTL)
-                    self.single_traceroute(ip,TTL,1,time_left)
-        except socket.gaierror:
-            print("Incorrect host")
-        if (type == 0):
-            sys.exit()
 
 class WebServer(NetworkApplication):
 
-    def handleRequest(self, tcpSocket):
+    def handleRequest(self, connection):
         # 1. Receive request message from the client on connection socket
         # 2. Extract the path of the requested object from the message (second part of the HTTP header)
         # 3. Read the corresponding file from disk
@@ -465,40 +1532,642 @@ class WebServer(NetworkApplication):
         # 5. Send the correct HTTP response error
         # 6. Send the content of the file to the socket
         # 7. Close the connection socket
-
-        msge = tcpSocket.recv(port)
-
-        file_Name = msge.split()[1]
-
-        #Assigning tempbuffer as an empty variable for now.
-        temp_Buffer = None
+        #Returns True if a complete request was taken off the buffer and answered.
+
+        #Stray blank lines before a request line are ignored (RFC 7230 section 3.5).
+        while connection.inBuffer.startswith(b'\r\n'):
+            del connection.inBuffer[:2]
+            connection.scanned = 0
+
+        #The request is only complete once the blank line ending the header has arrived.
+        headerEnd = self.findHeaderEnd(connection)
+        if headerEnd < 0:
+            #An overlong request line is refused without waiting for the rest of the head.
+            if (len(connection.inBuffer) > MAX_REQUEST_LINE
+                    and connection.inBuffer.find(b'\r\n', 0, MAX_REQUEST_LINE + 2) < 0):
+                self.refuseRequest(connection, 414)
+                return True
+            return False
+
+        parseStarted = time.perf_counter()
+        request = self.parseRequestHead(connection.inBuffer, headerEnd)
+        self.metrics.histograms['parse'].observe(time.perf_counter() - parseStarted)
+        if isinstance(request, int):
+            self.refuseRequest(connection, request)
+            return True
+        method, file_Name, version, headers = request
+        if 'transfer-encoding' in headers:
+            self.refuseRequest(connection, 400)
+            return True
+
+        #Skip over any request body. What has arrived is dropped now and readConnection drops the rest
+        #as it comes in, so a large upload never sits in the buffer and the next pipelined request still lines up.
+        body_Length = self.contentLength(headers)
+        if body_Length < 0:
+            self.refuseRequest(connection, 400)
+            return True
+        discarded = min(len(connection.inBuffer), headerEnd + 4 + body_Length)
+        del connection.inBuffer[:discarded]
+        connection.discardRemaining = headerEnd + 4 + body_Length - discarded
+        connection.scanned = 0
+
+        keepAlive = self.isKeepAlive(version, headers)
+        connection.requestCount += 1
+        self.metrics.counters['requests'] += 1
+        if connection.requestCount >= self.maxRequests:
+            keepAlive = False
+
+        if file_Name.partition('?')[0] == METRICS_PATH:
+            body = self.metrics.render(self.metricGauges())
+            hdr = "HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: %d\r\n" % (len(body))
+            self.queueResponse(connection, hdr.encode(), memoryview(body), keepAlive)
+            return True
+
+        path = self.resolvePath(file_Name)
+        if path is None:
+            hdr = "HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\n"
+            self.queueResponse(connection, hdr.encode(), keepAlive=keepAlive)
+            return True
+
+        readStarted = time.perf_counter()
         try:
-            #Exception returned if file can't be opened
-            file_from_disk = open(file_Name[1:], "r") 
-            
-            temp_Buffer = file_from_disk.read() #Reading file and storing it.
-            file_from_disk.close
-            
-        except FileNotFoundError:
-            #Seperating the header from message body using \r\n\r\n
-            hdr = "HTTP/1.1 404 Not Found.\r\n\r\n" 
-            tcpSocket.send(hdr.encode())
+            #Exception returned if file can't be opened.
+            staticFile, file_from_disk = self.openStaticFile(path)
 
-        if (temp_Buffer != None):
-            #Response header.
-            hdr = "HTTP/1.1 200 OK.\r\n\r\n" 
-            tcpSocket.send(hdr.encode())
-
-            i = 0
-            #Response body.
-            while(i < len(temp_Buffer)): 
-                tcpSocket.send(temp_Buffer[i].encode())
-                i += 1
+        except OSError as error:
+            #Seperating the header from message body using \r\n\r\n
+            if error.errno in NOT_FOUND_ERRNOS:
+                hdr = "HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\n"
+            elif error.errno in (errno.EACCES, errno.EPERM):
+                hdr = "HTTP/1.1 403 Forbidden\r\nContent-Length: 0\r\n"
+            else:
+                hdr = "HTTP/1.1 500 Internal Server Error\r\nContent-Length: 0\r\n"
+            self.queueResponse(connection, hdr.encode(), keepAlive=keepAlive)
+            return True
+        self.metrics.histograms['file_read'].observe(time.perf_counter() - readStarted)
+
+        if staticFile.compressible and self.acceptsGzip(headers.get('accept-encoding', '')):
+            variant = self.gzipVariant(path, staticFile, file_from_disk)
+            if variant is not None:
+                if file_from_disk is not None:
+                    file_from_disk.close()
+                staticFile, file_from_disk = variant
+
+        ranges = None
+        if method == 'GET' and 'range' in headers and staticFile.rangeApplies(headers):
+            ranges = self.parseRange(headers['range'], staticFile.size)
+
+        #Conditional requests for an unchanged file get the validators back and no body.
+        if method == 'HEAD' or staticFile.isNotModified(headers):
+            if file_from_disk is not None:
+                file_from_disk.close()
+            if method == 'HEAD':
+                self.queueResponse(connection, staticFile.okHeader, keepAlive=keepAlive)
+            else:
+                self.queueResponse(connection, staticFile.notModifiedHeader, keepAlive=keepAlive)
+        elif ranges is not None:
+            self.queueRanges(connection, staticFile, file_from_disk, ranges, keepAlive)
+        elif file_from_disk is None:
+            self.queueResponse(connection, staticFile.okHeader, memoryview(staticFile.body), keepAlive)
+        else:
+            #Uncached files are never read into memory, they are streamed straight from disk to the socket.
+            self.queueResponse(connection, staticFile.okHeader,
+                               FileSegment(file_from_disk, 0, staticFile.size), keepAlive)
+        return True
+
+    def parseRange(self, value, size):
+        #Returns the satisfiable ranges as sorted, merged (start, end) pairs with end inclusive.
+        #None means the header should be ignored and the whole file sent, [] means nothing in it is satisfiable.
+        unit, separator, specs = value.partition('=')
+        if unit.strip().lower() != 'bytes' or not separator:
+            return None
+        specs = [spec.strip() for spec in specs.split(',') if spec.strip()]
+        if not specs or len(specs) > MAX_RANGES:
+            return None
+
+        ranges = []
+        for spec in specs:
+            first, dash, last = spec.partition('-')
+            first = first.strip()
+            last = last.strip()
+            if not dash or not (first or last) or (first and not first.isdigit()) or (last and not last.isdigit()):
+                return None
+            if not first:
+                #bytes=-n is the last n bytes of the file.
+                if int(last) == 0:
+                    continue
+                start = max(size - int(last), 0)
+                end = size - 1
+            else:
+                start = int(first)
+                end = size - 1
+                if last:
+                    if int(last) < start:
+                        return None
+                    end = min(int(last), size - 1)
+            if start < size:
+                ranges.append((start, end))
+
+        #Overlapping or touching ranges are sent once, so a client can't make us send the file many times over.
+        ranges.sort()
+        merged = []
+        for start, end in ranges:
+            if merged and start <= merged[-1][1] + 1:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+            else:
+                merged.append((start, end))
+        return merged
+
+    def rangeBody(self, staticFile, file_from_disk, start, end, closeFile=True):
+        #Cached files are sliced without copying, files on disk are sent from an offset with sendfile.
+        if file_from_disk is None:
+            return memoryview(staticFile.body)[start:end + 1]
+        return FileSegment(file_from_disk, start, end - start + 1, closeFile)
+
+    def queueRanges(self, connection, staticFile, file_from_disk, ranges, keepAlive):
+        if not ranges:
+            if file_from_disk is not None:
+                file_from_disk.close()
+            hdr = "HTTP/1.1 416 Range Not Satisfiable\r\nContent-Range: bytes */%d\r\nContent-Length: 0\r\n" % (staticFile.size)
+            self.queueResponse(connection, hdr.encode(), keepAlive=keepAlive)
+            return
+
+        if len(ranges) == 1:
+            start, end = ranges[0]
+            self.queueResponse(connection, staticFile.partialHeader(start, end),
+                               self.rangeBody(staticFile, file_from_disk, start, end), keepAlive)
+            return
+
+        #Several ranges go out as multipart/byteranges, each part with its own Content-Range.
+        boundary = os.urandom(12).hex()
+        parts = []
+        length = 0
+        for index, (start, end) in enumerate(ranges):
+            partHeader = ("\r\n--%s\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d\r\n\r\n"
+                          % (boundary, staticFile.contentType, start, end, staticFile.size)).encode()
+            parts.append(memoryview(partHeader))
+            parts.append(self.rangeBody(staticFile, file_from_disk, start, end, index == len(ranges) - 1))
+            length += len(partHeader) + end - start + 1
+        closing = ("\r\n--%s--\r\n" % (boundary)).encode()
+        parts.append(memoryview(closing))
+        length += len(closing)
+
+        hdr = ("HTTP/1.1 206 Partial Content\r\nContent-Type: multipart/byteranges; boundary=%s\r\n"
+               "Content-Length: %d\r\n%s" % (boundary, length, staticFile.validators))
+        self.queueResponse(connection, hdr.encode(), parts, keepAlive)
+
+    def acceptsGzip(self, acceptEncoding):
+        #True unless gzip is missing from Accept-Encoding or refused with q=0.
+        accepted = False
+        for item in acceptEncoding.lower().split(','):
+            coding, separator, parameters = item.partition(';')
+            coding = coding.strip()
+            if coding not in ('gzip', '*'):
+                continue
+            quality = 1.0
+            name, equals, value = parameters.strip().partition('=')
+            if name.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+            if coding == 'gzip':
+                return quality > 0
+            accepted = quality > 0
+        return accepted
+
+    def gzipVariant(self, path, staticFile, file_from_disk):
+        #Returns (staticFile, file_from_disk) for a gzip version of the file or None to send it as it is.
+        #A precompressed .gz next to the file wins, otherwise it is compressed once and kept in memory.
+        #A cached file remembers it has no .gz so cache hits make no filesystem calls, it is looked for
+        #again on the cache's checkInterval like the file itself.
+        now = time.monotonic()
+        if now >= staticFile.gzipSiblingCheckDue:
+            try:
+                return self.openStaticFile(path, 'gzip')
+            except OSError:
+                #Missing or unreadable, either way the file is sent as it is or compressed here.
+                if self.fileCache is not None:
+                    staticFile.gzipSiblingCheckDue = now + self.fileCache.checkInterval
+
+        if self.gzipCache is None or staticFile.size < GZIP_MIN_SIZE or staticFile.size > self.gzipCache.maxFileSize:
+            return None
+        key = (path, staticFile.version)
+        variant = self.gzipCache.get(key)
+        if variant is None:
+            if staticFile.body is not None:
+                data = staticFile.body
+            else:
+                file_from_disk.seek(0)
+                data = file_from_disk.read()
+                if len(data) != staticFile.size:
+                    return None
+            #mtime=0 keeps the output identical for identical input.
+            compressed = gzip.compress(data, GZIP_LEVEL, mtime=0)
+            variant = StaticFile(path, staticFile.fileStat, compressed, 'gzip', len(compressed))
+            #Remembered even when it didn't shrink so we don't keep trying.
+            self.gzipCache.put(key, variant)
+        if variant.size >= staticFile.size:
+            return None
+        return variant, None
+
+    def openStaticFile(self, path, encoding=None):
+        #Returns (staticFile, file_from_disk) for a path from resolvePath. Files served from the cache
+        #come back with no open file. With encoding='gzip' it opens the precompressed sibling, path + '.gz', instead.
+        file_Path = path
+        if encoding is not None:
+            file_Path += '.gz'
+        if self.fileCache is not None:
+            staticFile = self.fileCache.get((file_Path, encoding))
+            if staticFile is not None:
+                self.metrics.counters['file_cache_hits'] += 1
+                return staticFile, None
+            self.metrics.counters['file_cache_misses'] += 1
+
+        #Binary mode so the bytes go out untouched.
+        file_from_disk = open(file_Path, "rb")
+        fileStat = os.fstat(file_from_disk.fileno())
+        if self.fileCache is None or fileStat.st_size > self.fileCache.maxFileSize:
+            return StaticFile(path, fileStat, encoding=encoding), file_from_disk
+
+        with file_from_disk:
+            body = file_from_disk.read()
+        staticFile = StaticFile(path, fileStat, body, encoding)
+        #Only cache what we read if the file didn't change underneath us.
+        if len(body) == staticFile.size:
+            self.fileCache.put((file_Path, encoding), staticFile)
+            return staticFile, None
+        return StaticFile(path, os.stat(file_Path), encoding=encoding), open(file_Path, "rb")
+
+    def findHeaderEnd(self, connection):
+        #Returns where the blank line ending the request head starts, or -1 if it hasn't arrived yet.
+        #Only bytes not already searched are looked at, backing up three in case the blank line was split.
+        headerEnd = connection.inBuffer.find(b'\r\n\r\n', max(0, connection.scanned - 3))
+        connection.scanned = len(connection.inBuffer) if headerEnd < 0 else headerEnd
+        return headerEnd
+
+    def resolvePath(self, target):
+        #Maps a request target onto a file under the document root, or None if it can't name one.
+        #Dot segments are resolved after percent-decoding, so neither ../ nor %2e%2e/ climbs out of the root.
+        if not target.startswith('/'):
+            #Absolute-form, as sent to a proxy (RFC 7230 section 5.3.2). An empty path means /.
+            target = urllib.parse.urlsplit(target).path or '/'
+            if not target.startswith('/'):
+                return None
+        try:
+            path = urllib.parse.unquote(target.partition('?')[0].partition('#')[0], errors='strict')
+        except UnicodeDecodeError:
+            return None
+        if '\0' in path:
+            return None
+
+        segments = []
+        for segment in path.split('/'):
+            if segment == '..':
+                if not segments:
+                    return None
+                segments.pop()
+            elif segment and segment != '.':
+                segments.append(segment)
+        if path.endswith(('/', '/.', '/..')):
+            segments.append('index.html')
+        return os.path.join(self.documentRoot, *segments)
+
+    def refuseRequest(self, connection, status):
+        #The rest of the buffer can't be trusted once a request head is bad, so the connection is closed.
+        connection.inBuffer.clear()
+        connection.scanned = 0
+        hdr = "HTTP/1.1 %d %s\r\nContent-Length: 0\r\n" % (status, REFUSAL_REASONS[status])
+        self.queueResponse(connection, hdr.encode(), keepAlive=False)
+
+    def queueResponse(self, connection, header, body=None, keepAlive=True):
+        #Responses are queued and written by the event loop so one slow client never blocks the others.
+        #The header is passed without its final blank line so the Connection field can be added here.
+        #body can be a list of pieces, as for multipart ranges.
+        if keepAlive:
+            header += b'Connection: keep-alive\r\n\r\n'
+        else:
+            header += b'Connection: close\r\n\r\n'
+            connection.closeAfterSend = True
+        #Status code straight out of the status line, "HTTP/1.1 200".
+        self.metrics.countResponse(header[9:12])
+        if connection.sendStarted is None:
+            connection.sendStarted = time.perf_counter()
+        connection.outQueue.append(memoryview(header))
+        if isinstance(body, list):
+            connection.outQueue.extend(body)
+        elif body is not None:
+            connection.outQueue.append(body)
+
+    def serviceRequests(self, connection):
+        #Answer pipelined requests one at a time, only parsing the next once the previous response is out.
+        while not connection.closed and not connection.outQueue and not connection.closeAfterSend:
+            if not self.handleRequest(connection):
+                break
+            self.flushConnection(connection)
+
+        if not connection.closed and not connection.outQueue:
+            connection.lastActive = time.monotonic()
+            self.setEvents(connection, selectors.EVENT_READ)
+
+    def setEvents(self, connection, events):
+        if connection.events != events:
+            self.selector.modify(connection.tcpSocket, events, connection)
+            connection.events = events
+
+    def sendFileSegment(self, tcpSocket, segment):
+        #Returns the number of bytes sent, raising BlockingIOError when the socket is full.
+        if self.useSendfile:
+            try:
+                return os.sendfile(tcpSocket.fileno(), segment.fileObject.fileno(),
+                                   segment.offset, segment.remaining)
+            except OSError as error:
+                if error.errno not in (errno.EINVAL, errno.ENOSYS, errno.ENOTSOCK, errno.EOPNOTSUPP):
+                    raise
+                #Kernel or file system can't sendfile, use the chunked copy from now on.
+                self.useSendfile = False
+
+        segment.fileObject.seek(segment.offset)
+        length = segment.fileObject.readinto(self.sendChunk[:min(segment.remaining, SEND_CHUNK_SIZE)])
+        if not length:
+            return 0
+        return tcpSocket.send(self.sendChunk[:length])
+
+    def flushConnection(self, connection):
+        #Write as much of the pending response as the socket will take without blocking.
+        outQueue = connection.outQueue
+        progressed = False
+        try:
+            while outQueue:
+                item = outQueue[0]
+                if isinstance(item, FileSegment):
+                    sent = self.sendFileSegment(connection.tcpSocket, item)
+                    if sent == 0:
+                        #File got shorter than the Content-Length we promised.
+                        self.closeConnection(connection)
+                        return
+                    self.metrics.counters['bytes_sent'] += sent
+                    progressed = True
+                    item.offset += sent
+                    item.remaining -= sent
+                    if item.remaining == 0:
+                        item.close()
+                        outQueue.popleft()
+                else:
+                    sent = connection.tcpSocket.send(item)
+                    self.metrics.counters['bytes_sent'] += sent
+                    progressed = True
+                    if sent < len(item):
+                        outQueue[0] = item[sent:]
+                    else:
+                        outQueue.popleft()
+        except BlockingIOError:
+            pass
+        except OSError:
+            self.closeConnection(connection)
+            return
+
+        if progressed:
+            connection.lastActive = time.monotonic()
+        if not outQueue and connection.sendStarted is not None:
+            self.metrics.histograms['send'].observe(time.perf_counter() - connection.sendStarted)
+            connection.sendStarted = None
+
+        if outQueue:
+            #Stop reading while a response is pending, a client can't pipeline us out of memory.
+            self.setEvents(connection, selectors.EVENT_WRITE)
+        elif connection.closeAfterSend:
+            self.closeConnection(connection)
+
+    def acceptConnections(self, server_Socket):
+        #Accept every pending connection the kernel has queued, up to the connection limit.
+        while len(self.connections) < self.maxConnections:
+            acceptStarted = time.perf_counter()
+            try:
+                tcpSocket, addr = server_Socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as error:
+                #The client gave up before we got to it, that only costs that one connection.
+                if error.errno in (errno.ECONNABORTED, errno.EPROTO):
+                    continue
+                #Usually EMFILE or ENFILE: stop accepting until a connection closes or the next sweep.
+                break
+            tcpSocket.setblocking(False)
+            #Header and body go out in separate sends, Nagle would hold a small body back until the header is ACKed.
+            tcpSocket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            connection = WebConnection(tcpSocket, addr)
+            self.connections.add(connection)
+            self.selector.register(tcpSocket, selectors.EVENT_READ, connection)
+            self.metrics.counters['connections'] += 1
+            self.metrics.histograms['accept'].observe(time.perf_counter() - acceptStarted)
+
+        #Connection limit reached, leave further clients in the listen backlog.
+        if self.accepting:
+            self.selector.unregister(server_Socket)
+            self.accepting = False
+
+    def readConnection(self, connection):
+        try:
+            length = connection.tcpSocket.recv_into(self.recvChunk)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            length = 0
+
+        if not length:
+            self.closeConnection(connection)
+            return
+
+        data = self.recvChunk[:length]
+        if connection.discardRemaining:
+            skipped = min(connection.discardRemaining, length)
+            connection.discardRemaining -= skipped
+            data = data[skipped:]
+        connection.inBuffer += data
+        connection.lastActive = time.monotonic()
+        if len(connection.inBuffer) > MAX_REQUEST_SIZE and self.findHeaderEnd(connection) < 0:
+            self.refuseRequest(connection, 431)
+            self.flushConnection(connection)
+            return
+
+        self.serviceRequests(connection)
+
+    def metricGauges(self):
+        gauges = {'open_connections': ('Client connections currently open.', len(self.connections))}
+        if self.fileCache is not None:
+            gauges['file_cache_bytes'] = ('Bytes of file contents held in memory.', self.fileCache.totalBytes)
+        if self.gzipCache is not None:
+            gauges['gzip_cache_bytes'] = ('Bytes of gzipped file contents held in memory.', self.gzipCache.totalBytes)
+        return gauges
+
+    def closeIdleConnections(self):
+        #Connections that have sat with nothing to do for too long are dropped, and so are
+        #clients that stopped reading a response, since a write only counts as activity when it makes progress.
+        cutoff = time.monotonic() - self.keepAliveTimeout
+        for connection in list(self.connections):
+            if connection.lastActive < cutoff:
+                self.closeConnection(connection)
+
+    def closeConnection(self, connection):
+        if connection.closed:
+            return
+        connection.closed = True
+        self.connections.discard(connection)
+        self.selector.unregister(connection.tcpSocket)
+        connection.tcpSocket.close()
+        for item in connection.outQueue:
+            if isinstance(item, FileSegment):
+                item.close()
+        connection.outQueue.clear()
+
+        #A slot has freed up so start taking new connections again.
+        self.resumeAccepting()
+
+    def resumeAccepting(self):
+        if not self.accepting and not self.stopping and len(self.connections) < self.maxConnections:
+            self.selector.register(self.server_Socket, selectors.EVENT_READ, None)
+            self.accepting = True
+
+    def createServerSocket(self, args):
+        server_Socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        #Allows the use of the same port.
+        server_Socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if args.reuseport:
+            #Every worker binds its own socket and the kernel spreads new connections across them.
+            server_Socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
 
-            tcpSocket.close()
+        #Address is not needed here.
+        server_Socket.bind(('',args.port))
+        server_Socket.listen(args.backlog)
+        #Never block in accept(), the selector tells us when clients are waiting.
+        server_Socket.setblocking(False)
+        return server_Socket
+
+    def requestShutdown(self, signum, frame):
+        self.stopping = True
+
+    def beginShutdown(self):
+        #Stop taking new connections and let the ones in flight finish their current response.
+        if self.accepting:
+            self.selector.unregister(self.server_Socket)
+            self.accepting = False
+        self.server_Socket.close()
+        for connection in list(self.connections):
+            connection.closeAfterSend = True
+            if not connection.outQueue:
+                self.closeConnection(connection)
+
+    def serveForever(self, server_Socket):
+        self.server_Socket = server_Socket
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(server_Socket, selectors.EVENT_READ, None)
+        self.accepting = True
+
+        #Wake up often enough to enforce the idle timeout even when no traffic arrives.
+        sweepInterval = min(1.0, self.keepAliveTimeout / 2)
+        nextSweep = time.monotonic() + sweepInterval
+        nextStats = time.monotonic() + self.statsInterval
+        shutdownDeadline = None
+        try:
+            while shutdownDeadline is None or (self.connections and time.monotonic() < shutdownDeadline):
+                for key, mask in self.selector.select(sweepInterval):
+                    if key.data is None:
+                        self.acceptConnections(server_Socket)
+                        continue
+                    try:
+                        if mask & selectors.EVENT_READ:
+                            self.readConnection(key.data)
+                        elif mask & selectors.EVENT_WRITE:
+                            self.flushConnection(key.data)
+                            self.serviceRequests(key.data)
+                    except Exception:
+                        #Every client shares this loop, so a bug hit by one request only costs that client its connection.
+                        traceback.print_exc()
+                        self.closeConnection(key.data)
+
+                if time.monotonic() >= nextSweep:
+                    self.closeIdleConnections()
+                    #Accepting may have been paused by running out of file descriptors with nothing open to close.
+                    self.resumeAccepting()
+                    nextSweep = time.monotonic() + sweepInterval
+
+                if self.statsInterval and time.monotonic() >= nextStats:
+                    print(self.metrics.statsLine(self.metricGauges()), file=sys.stderr, flush=True)
+                    nextStats = time.monotonic() + self.statsInterval
+
+                if self.stopping and shutdownDeadline is None:
+                    self.beginShutdown()
+                    shutdownDeadline = time.monotonic() + SHUTDOWN_GRACE_PERIOD
+
+        except KeyboardInterrupt:
+            print('Server terminated.')
+
+        finally:
+            for connection in list(self.connections):
+                self.closeConnection(connection)
+            self.selector.close()
+            server_Socket.close()
+
+    def spawnWorker(self, args, server_Socket):
+        pid = os.fork()
+        if pid:
+            return pid
+
+        #Child: the parent handles Ctrl-C and tells us to stop with SIGTERM.
+        exitCode = 0
+        try:
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, self.requestShutdown)
+            if server_Socket is None:
+                server_Socket = self.createServerSocket(args)
+            self.serveForever(server_Socket)
+        except Exception:
+            traceback.print_exc()
+            exitCode = 1
+        finally:
+            #Never fall back into the parent's code.
+            os._exit(exitCode)
+
+    def runWorkers(self, args):
+        #With SO_REUSEPORT each worker binds its own socket, otherwise they all share the parent's.
+        server_Socket = None if args.reuseport else self.createServerSocket(args)
+
+        workers = {}
+
+        def stopWorkers(signum, frame):
+            #Pass the shutdown on straight away, waitpid() below won't return until a worker exits.
+            self.stopping = True
+            for pid in workers:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+
+        signal.signal(signal.SIGTERM, stopWorkers)
+        signal.signal(signal.SIGINT, stopWorkers)
+        for i in range(args.workers):
+            workers[self.spawnWorker(args, server_Socket)] = time.monotonic()
+
+        while workers:
+            try:
+                pid, status = os.waitpid(-1, 0)
+            except ChildProcessError:
+                break
+            startedAt = workers.pop(pid, None)
+            if startedAt is None or self.stopping:
+                continue
+
+            print('Worker %d exited, respawning.' % (pid), file=sys.stderr)
+            #Don't spin forking workers that die straight away.
+            if time.monotonic() - startedAt < 1:
+                time.sleep(1)
+            if not self.stopping:
+                workers[self.spawnWorker(args, server_Socket)] = time.monotonic()
 
-       
-        pass
+        if server_Socket is not None:
+            server_Socket.close()
+        print('Server terminated.')
 
     def __init__(self, args):
         print('Web Server starting on port: %i...' % (args.port))
@@ -507,35 +2176,1030 @@ class WebServer(NetworkApplication):
         # 3. Continuously listen for connections to server socket
         # 4. When a connection is accepted, call handleRequest function, passing new connection socket (see https://docs.python.org/3/library/socket.html#socket.socket.accept)
         # 5. Close server socket
-    
-        server_Socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        #Allows the use of the same port.
-        server_Socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1) 
 
-        #Address is not needed here.
-        server_Socket.bind(('',args.port))
-        server_Socket.listen(1)
-
-        while True:
-            
+        self.maxConnections = args.max_connections
+        self.maxRequests = args.max_requests
+        self.keepAliveTimeout = args.keepalive_timeout
+        self.connections = set()
+        self.stopping = False
+        #Receive and fallback send buffers are shared by every connection.
+        self.recvChunk = memoryview(bytearray(RECV_BUFFER_SIZE))
+        self.useSendfile = hasattr(os, 'sendfile')
+        self.sendChunk = memoryview(bytearray(SEND_CHUNK_SIZE))
+        #Every path served is resolved under here.
+        self.documentRoot = os.path.abspath(args.root)
+        self.fileCache = None
+        if args.cache_size > 0:
+            self.fileCache = StaticFileCache(args.cache_size, args.cache_max_file, args.cache_check_interval)
+        self.gzipCache = None
+        if args.gzip_cache_size > 0:
+            self.gzipCache = CompressedFileCache(args.gzip_cache_size, args.gzip_max_file)
+        self.statsInterval = args.stats_interval
+        self.metrics = ServerMetrics('web', {
+            'connections': 'Client connections accepted.',
+            'requests': 'Requests parsed.',
+            'bytes_sent': 'Response bytes written to clients.',
+            'file_cache_hits': 'Files served from the in-memory cache.',
+            'file_cache_misses': 'Files opened from disk with the in-memory cache enabled.',
+        }, {
+            'accept': 'Time to accept and set up a client connection.',
+            'parse': 'Time to parse a request head.',
+            'file_read': 'Time to open, stat and, for cached files, read the requested file.',
+            'send': 'Time from queueing a response to the last byte being written.',
+        })
+
+        if args.workers > 1:
+            self.runWorkers(args)
+        else:
+            signal.signal(signal.SIGTERM, self.requestShutdown)
+            self.serveForever(self.createServerSocket(args))
+
+
+
+
+class ProxyCacheEntry:
+    #Metadata for one cached response, the body is stored next to it on disk.
+
+    def __init__(self, key, url, status, reason, headers, size, storedAt, expires, vary):
+        self.key = key
+        self.url = url
+        self.status = status
+        self.reason = reason
+        #End-to-end response headers only, framing headers are rebuilt when the entry is served.
+        self.headers = headers
+        self.size = size
+        self.storedAt = storedAt
+        self.expires = expires
+        #Request header values named by Vary that this copy of the response was fetched with.
+        self.vary = vary
+
+    def toDict(self):
+        return {'key': self.key, 'url': self.url, 'status': self.status, 'reason': self.reason,
+                'headers': self.headers, 'size': self.size, 'storedAt': self.storedAt,
+                'expires': self.expires, 'vary': self.vary}
+
+    @classmethod
+    def fromDict(cls, data):
+        return cls(data['key'], data['url'], data['status'], data['reason'],
+                   [tuple(header) for header in data['headers'] if header[0].lower() != 'age'], data['size'],
+                   data['storedAt'], data['expires'], data['vary'])
+
+
+class ProxyDiskCache:
+    #Size-bounded LRU index over response bodies kept in a cache directory.
+
+    def __init__(self, directory, maxBytes, maxObjectSize):
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self.maxObjectSize = maxObjectSize
+        self.entries = collections.OrderedDict()
+        self.totalBytes = 0
+        os.makedirs(directory, exist_ok=True)
+        self.load()
+
+    def keyFor(self, url):
+        return hashlib.sha256(url.encode('utf-8')).hexdigest()[:32]
+
+    def bodyPath(self, key):
+        return os.path.join(self.directory, key + '.body')
+
+    def metaPath(self, key):
+        return os.path.join(self.directory, key + '.meta')
+
+    def load(self):
+        #Rebuild the index from a previous run, oldest entries first so they are evicted first.
+        found = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith('.tmp'):
+                #Left behind by a fetch that never finished.
+                os.unlink(path)
+                continue
+            if not name.endswith('.meta'):
+                continue
             try:
-                tcpSocket, addr = server_Socket.accept()
-                self.handleRequest(tcpSocket)
+                with open(path) as metaFile:
+                    entry = ProxyCacheEntry.fromDict(json.load(metaFile))
+                if os.path.getsize(self.bodyPath(entry.key)) != entry.size:
+                    raise ValueError('body does not match metadata')
+            except (OSError, ValueError, KeyError, TypeError):
+                self.deleteFiles(name[:-len('.meta')])
+                continue
+            found.append(entry)
+
+        for entry in sorted(found, key=lambda entry: entry.storedAt):
+            self.entries[entry.key] = entry
+            self.totalBytes += entry.size
+        self.evict()
+
+    def lookup(self, url, fields):
+        #Returns the fresh entry for url matching the request's Vary headers, or None.
+        key = self.keyFor(url)
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry.expires <= time.time():
+            self.remove(key)
+            return None
+        for name, value in entry.vary.items():
+            if fields.get(name, '') != value:
+                return None
+        self.entries.move_to_end(key)
+        return entry
+
+    def newSpoolFile(self):
+        #Bodies are written to a temporary file in the cache directory so storing them is just a rename.
+        fd, path = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+        return os.fdopen(fd, 'wb'), path
+
+    def store(self, entry, spoolPath):
+        if entry.size > self.maxObjectSize or entry.size > self.maxBytes:
+            os.unlink(spoolPath)
+            return False
+
+        self.remove(entry.key)
+        os.replace(spoolPath, self.bodyPath(entry.key))
+        metaSpool, metaSpoolPath = self.newSpoolFile()
+        with metaSpool:
+            metaSpool.write(json.dumps(entry.toDict()).encode('utf-8'))
+        os.replace(metaSpoolPath, self.metaPath(entry.key))
+
+        self.entries[entry.key] = entry
+        self.totalBytes += entry.size
+        self.evict()
+        return entry.key in self.entries
+
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.totalBytes -= entry.size
+            self.deleteFiles(key)
+
+    def evict(self):
+        #Drop least recently used responses until we are back inside the budget.
+        while self.totalBytes > self.maxBytes:
+            key, entry = self.entries.popitem(last=False)
+            self.totalBytes -= entry.size
+            self.deleteFiles(key)
+
+    def deleteFiles(self, key):
+        for path in (self.bodyPath(key), self.metaPath(key)):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
 
-            except KeyboardInterrupt:
-                print('Server terminated.')
-                tcpSocket.close()
-                return
 
-        server_Socket.close()
+class UpstreamPool:
+    #Idle keep-alive connections to origin servers, reused across client requests.
+
+    def __init__(self, maxIdlePerOrigin, idleTimeout):
+        self.maxIdlePerOrigin = maxIdlePerOrigin
+        self.idleTimeout = idleTimeout
+        #(host, port) -> list of (reader, writer, idleSince), most recently used last.
+        self.idle = {}
+
+    async def acquire(self, origin, timeout):
+        #Returns (reader, writer, reused) for origin, opening a new connection if none is idle.
+        connections = self.idle.get(origin)
+        while connections:
+            reader, writer, idleSince = connections.pop()
+            if writer.is_closing() or reader.at_eof():
+                writer.close()
+                continue
+            return reader, writer, True
+
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(origin[0], origin[1], limit=MAX_REQUEST_SIZE), timeout)
+        return reader, writer, False
+
+    def release(self, origin, reader, writer):
+        connections = self.idle.setdefault(origin, [])
+        if len(connections) >= self.maxIdlePerOrigin or writer.is_closing():
+            writer.close()
+            return
+        connections.append((reader, writer, time.monotonic()))
+
+    def evictIdle(self):
+        cutoff = time.monotonic() - self.idleTimeout
+        for origin in list(self.idle):
+            keep = []
+            for reader, writer, idleSince in self.idle[origin]:
+                if idleSince < cutoff or reader.at_eof():
+                    writer.close()
+                else:
+                    keep.append((reader, writer, idleSince))
+            if keep:
+                self.idle[origin] = keep
+            else:
+                del self.idle[origin]
+
+    def closeAll(self):
+        for connections in self.idle.values():
+            for reader, writer, idleSince in connections:
+                writer.close()
+        self.idle.clear()
 
 
+class Proxy(NetworkApplication):
 
+    def cacheLifetime(self, status, fields):
+        #Seconds a response may be served from the cache, None if it must not be stored.
+        if status not in CACHEABLE_STATUS_CODES or 'set-cookie' in fields or fields.get('vary') == '*':
+            return None
+
+        directives = {}
+        for directive in fields.get('cache-control', '').lower().split(','):
+            name, separator, value = directive.strip().partition('=')
+            directives[name] = value.strip('"')
+        if 'no-store' in directives or 'private' in directives or 'no-cache' in directives:
+            return None
+
+        #Shared caches prefer s-maxage over max-age over Expires.
+        for name in ('s-maxage', 'max-age'):
+            if name in directives:
+                try:
+                    return max(0, int(directives[name]))
+                except ValueError:
+                    return None
+
+        if 'expires' in fields:
+            try:
+                expires = email.utils.parsedate_to_datetime(fields['expires']).timestamp()
+                date = email.utils.parsedate_to_datetime(fields['date']).timestamp() if 'date' in fields else time.time()
+            except (TypeError, ValueError):
+                #An invalid Expires means already expired.
+                return None
+            return max(0, expires - date)
+
+        return None
+
+    def endToEndHeaders(self, headers, fields):
+        #Drops hop-by-hop headers, including any the Connection header names.
+        hopByHop = set(HOP_BY_HOP_HEADERS)
+        for token in fields.get('connection', '').split(','):
+            hopByHop.add(token.strip().lower())
+        return [(name, value) for name, value in headers if name.lower() not in hopByHop]
+
+    def buildHead(self, firstLine, headers, extra):
+        lines = [firstLine]
+        lines.extend('%s: %s' % header for header in headers)
+        lines.extend(extra)
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+    async def sendError(self, writer, status, reason, keepAlive=False):
+        hdr = "HTTP/1.1 %d %s\r\nContent-Length: 0\r\nConnection: %s\r\n\r\n" % (
+            status, reason, 'keep-alive' if keepAlive else 'close')
+        writer.write(hdr.encode())
+        await writer.drain()
+        return keepAlive
+
+    async def readResponseHead(self, reader):
+        #Returns (version, status, reason, headers), skipping any interim 1xx responses.
+        while True:
+            head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), self.upstreamTimeout)
+            lines = head[:-4].split(b'\r\n')
+            status_Parts = lines[0].split(None, 2)
+            if len(status_Parts) < 2 or not status_Parts[0].startswith(b'HTTP/') or not status_Parts[1].isdigit():
+                raise ValueError('malformed status line')
+            headers = self.parseHeaders(lines[1:])
+            if headers is None:
+                raise ValueError('malformed response header')
+            status = int(status_Parts[1])
+            if status < 200 and status != 101:
+                continue
+            reason = status_Parts[2].decode('latin-1') if len(status_Parts) > 2 else ''
+            return status_Parts[0].decode('latin-1'), status, reason, headers
+
+    def bodyFraming(self, method, status, fields):
+        #How the response body is delimited: ('none'|'length'|'chunked'|'close', length).
+        if method == 'HEAD' or status < 200 or status in (204, 304):
+            return 'none', 0
+        if 'chunked' in fields.get('transfer-encoding', '').lower():
+            return 'chunked', None
+        if 'content-length' in fields:
+            length = self.contentLength(fields)
+            if length < 0:
+                raise ValueError('bad Content-Length from origin')
+            return 'length', length
+        return 'close', None
+
+    async def readBody(self, reader, framing, length):
+        #Yields the decoded body in chunks of at most SEND_CHUNK_SIZE bytes.
+        if framing == 'length':
+            remaining = length
+            while remaining:
+                chunk = await reader.read(min(remaining, SEND_CHUNK_SIZE))
+                if not chunk:
+                    raise ConnectionError('upstream closed before the end of the body')
+                remaining -= len(chunk)
+                yield chunk
+
+        elif framing == 'chunked':
+            while True:
+                size_Line = await reader.readuntil(b'\r\n')
+                remaining = int(size_Line.split(b';')[0], 16)
+                if remaining == 0:
+                    #Skip any trailer fields up to the final blank line.
+                    while await reader.readuntil(b'\r\n') != b'\r\n':
+                        pass
+                    return
+                while remaining:
+                    chunk = await reader.read(min(remaining, SEND_CHUNK_SIZE))
+                    if not chunk:
+                        raise ConnectionError('upstream closed inside a chunk')
+                    remaining -= len(chunk)
+                    yield chunk
+                await reader.readexactly(2)
+
+        elif framing == 'close':
+            while True:
+                chunk = await reader.read(SEND_CHUNK_SIZE)
+                if not chunk:
+                    return
+                yield chunk
+
+    async def sendCachedResponse(self, entry, bodyFile, writer, keepAlive, cacheStatus):
+        #Cached bodies go from disk to the client socket with sendfile, never through Python.
+        age = max(0, int(time.time() - entry.storedAt))
+        writer.write(self.buildHead('HTTP/1.1 %d %s' % (entry.status, entry.reason), entry.headers,
+                                    ['Content-Length: %d' % entry.size, 'Age: %d' % age,
+                                     'X-Cache: %s' % cacheStatus,
+                                     'Connection: %s' % ('keep-alive' if keepAlive else 'close')]))
+        await writer.drain()
+        if entry.size:
+            await asyncio.get_running_loop().sendfile(writer.transport, bodyFile, 0, entry.size)
+
+    async def relayResponse(self, request, cacheable, responseHead, upstreamReader, clientWriter, keepAlive):
+        #Streams the origin's response to the client, storing it on the way when it is cacheable.
+        #Returns (keepAlive, reusable), reusable meaning the upstream connection can go back in the pool.
+        method, url, version, headers, fields = request
+        responseVersion, status, reason, responseHeaders = responseHead
+        responseFields = self.headerFields(responseHeaders)
+        framing, length = self.bodyFraming(method, status, responseFields)
+        reusable = framing != 'close' and self.isKeepAlive(responseVersion, responseFields)
+        endToEnd = self.endToEndHeaders(responseHeaders, responseFields)
+        now = time.time()
+
+        lifetime = None
+        if cacheable:
+            lifetime = self.cacheLifetime(status, responseFields)
+        if lifetime is not None and framing == 'length' and length > self.cache.maxObjectSize:
+            lifetime = None
+
+        spool = spoolPath = None
+        if lifetime is not None:
+            spool, spoolPath = self.cache.newSpoolFile()
+
+        statusLine = 'HTTP/1.1 %d %s' % (status, reason)
+        bodyHeaders = [(name, value) for name, value in endToEnd if name.lower() != 'content-length']
+        chunkedToClient = False
+        headSent = False
+
+        async def sendHead():
+            #Sent ahead of the first chunk of the body, the origin's framing decides the client's.
+            nonlocal chunkedToClient, keepAlive
+            extra = ['X-Cache: MISS']
+            if framing == 'length':
+                extra.append('Content-Length: %d' % length)
+            elif version == 'HTTP/1.1':
+                chunkedToClient = True
+                extra.append('Transfer-Encoding: chunked')
+            else:
+                keepAlive = False
+            extra.append('Connection: %s' % ('keep-alive' if keepAlive else 'close'))
+            clientWriter.write(self.buildHead(statusLine, bodyHeaders, extra))
+
+        async def sendChunk(chunk):
+            if chunkedToClient:
+                clientWriter.write(b'%x\r\n' % len(chunk))
+                clientWriter.write(chunk)
+                clientWriter.write(b'\r\n')
+            else:
+                clientWriter.write(chunk)
+            await clientWriter.drain()
 
-class Proxy(NetworkApplication):
+        try:
+            if framing == 'none':
+                clientWriter.write(self.buildHead(statusLine, endToEnd,
+                                                  ['X-Cache: MISS', 'Connection: %s' % ('keep-alive' if keepAlive else 'close')]))
+                await clientWriter.drain()
+                return keepAlive, reusable
+
+            #Each chunk goes to the client as soon as it arrives, a cacheable body is written to the spool file on the way.
+            spooled = 0
+            async for chunk in self.readBody(upstreamReader, framing, length):
+                if not headSent:
+                    await sendHead()
+                    headSent = True
+                if spool is not None:
+                    if spooled + len(chunk) <= self.cache.maxObjectSize:
+                        spool.write(chunk)
+                        spooled += len(chunk)
+                    else:
+                        #Too big to cache after all, the rest is only streamed.
+                        spool.close()
+                        os.unlink(spoolPath)
+                        spool = spoolPath = None
+                await sendChunk(chunk)
+
+            if not headSent:
+                await sendHead()
+            if chunkedToClient:
+                clientWriter.write(b'0\r\n\r\n')
+            await clientWriter.drain()
+
+            if spool is not None:
+                spool.close()
+                #The origin's Age is folded into storedAt, sendCachedResponse adds a fresh one.
+                storedHeaders = [(name, value) for name, value in bodyHeaders if name.lower() != 'age']
+                entry = ProxyCacheEntry(self.cache.keyFor(url), url, status, reason, storedHeaders, spooled,
+                                        now - self.initialAge(responseFields), now + lifetime,
+                                        self.varyValues(responseFields, fields))
+                self.cache.store(entry, spoolPath)
+                spool = spoolPath = None
+            return keepAlive, reusable
+
+        except (ValueError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            #Once part of the response is out the only safe thing left is to drop the client.
+            if headSent:
+                raise ConnectionError('upstream response broke off')
+            raise
+
+        finally:
+            if spool is not None:
+                spool.close()
+                os.unlink(spoolPath)
+
+    def initialAge(self, fields):
+        try:
+            return max(0, int(fields.get('age', 0)))
+        except ValueError:
+            return 0
+
+    def varyValues(self, responseFields, requestFields):
+        names = [name.strip().lower() for name in responseFields.get('vary', '').split(',') if name.strip()]
+        return {name: requestFields.get(name, '') for name in names}
+
+    def buildUpstreamRequest(self, method, url, headers, fields, bodyLength):
+        #Origin-form request head with the client's end-to-end headers. The body follows it separately.
+        path = url.path or '/'
+        if url.query:
+            path += '?' + url.query
+        upstreamHeaders = [(name, value) for name, value in self.endToEndHeaders(headers, fields)
+                           if name.lower() not in ('host', 'content-length')]
+        extra = ['Host: %s' % url.netloc]
+        if bodyLength:
+            extra.append('Content-Length: %d' % bodyLength)
+        return self.buildHead('%s %s HTTP/1.1' % (method, path), upstreamHeaders, extra)
+
+    async def sendRequestBody(self, reader, upstreamWriter, length):
+        #Copies the client's request body to the origin SEND_CHUNK_SIZE at a time so an upload never
+        #sits in memory. Returns False if the client went away before sending all of it.
+        while length > 0:
+            chunk = await reader.read(min(length, SEND_CHUNK_SIZE))
+            if not chunk:
+                return False
+            length -= len(chunk)
+            upstreamWriter.write(chunk)
+            await upstreamWriter.drain()
+        return True
+
+    async def forwardRequest(self, request, cacheable, clientWriter, keepAlive, bodyReader=None, bodyLength=0):
+        #A request body is read from bodyReader while it is sent, so the request can't be retried once it has one.
+        method, url, version, headers, fields = request
+        target = urllib.parse.urlsplit(url)
+        origin = (target.hostname, target.port or 80)
+        upstreamRequest = self.buildUpstreamRequest(method, target, headers, fields, bodyLength)
+
+        while True:
+            upstreamStarted = time.perf_counter()
+            try:
+                upstreamReader, upstreamWriter, reused = await self.pool.acquire(origin, self.upstreamTimeout)
+            except (OSError, asyncio.TimeoutError):
+                self.metrics.counters['upstream_errors'] += 1
+                #The body hasn't been read, the connection can only be kept if there isn't one.
+                return await self.sendError(clientWriter, 502, 'Bad Gateway', keepAlive and not bodyLength)
+
+            self.metrics.counters['upstream_requests'] += 1
+            if reused:
+                self.metrics.counters['upstream_reused'] += 1
+            try:
+                upstreamWriter.write(upstreamRequest)
+                await upstreamWriter.drain()
+                if bodyLength and not await self.sendRequestBody(bodyReader, upstreamWriter, bodyLength):
+                    upstreamWriter.close()
+                    return False
+                responseHead = await self.readResponseHead(upstreamReader)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                upstreamWriter.close()
+                #The origin closed a pooled connection while it sat idle, try again on a fresh one.
+                if reused and method in IDEMPOTENT_METHODS and not bodyLength:
+                    continue
+                self.metrics.counters['upstream_errors'] += 1
+                return await self.sendError(clientWriter, 502, 'Bad Gateway')
+            except asyncio.TimeoutError:
+                upstreamWriter.close()
+                self.metrics.counters['upstream_errors'] += 1
+                return await self.sendError(clientWriter, 504, 'Gateway Timeout')
+            except (ValueError, asyncio.LimitOverrunError):
+                upstreamWriter.close()
+                self.metrics.counters['upstream_errors'] += 1
+                return await self.sendError(clientWriter, 502, 'Bad Gateway')
+            #Connecting (or taking a pooled connection) until the origin's response head has arrived.
+            self.metrics.histograms['upstream'].observe(time.perf_counter() - upstreamStarted)
+            break
+
+        reusable = False
+        try:
+            keepAlive, reusable = await self.relayResponse(request, cacheable, responseHead, upstreamReader,
+                                                           clientWriter, keepAlive)
+            return keepAlive
+        except (ValueError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            return await self.sendError(clientWriter, 502, 'Bad Gateway')
+        finally:
+            if reusable:
+                self.pool.release(origin, upstreamReader, upstreamWriter)
+            else:
+                upstreamWriter.close()
+
+    async def serveFromCache(self, url, fields, writer, keepAlive):
+        #Returns True if a fresh cached copy was sent to the client.
+        entry = self.cache.lookup(url, fields)
+        if entry is None:
+            return False
+        try:
+            bodyFile = open(self.cache.bodyPath(entry.key), 'rb')
+        except OSError:
+            self.cache.remove(entry.key)
+            return False
+        with bodyFile:
+            await self.sendCachedResponse(entry, bodyFile, writer, keepAlive, 'HIT')
+        return True
+
+    async def fetchCoalesced(self, request, writer, keepAlive):
+        #Concurrent misses for the same URL share one upstream fetch: the first request goes to the
+        #origin and the rest wait for it to land in the cache, fetching for themselves only if it doesn't.
+        method, url, version, headers, fields = request
+        inflight = self.inflight.get(url)
+        if inflight is not None:
+            self.metrics.counters['coalesced'] += 1
+            try:
+                await asyncio.wait_for(asyncio.shield(inflight), self.upstreamTimeout)
+            except asyncio.TimeoutError:
+                pass
+            #Hit or miss is only known once the shared fetch is over, so it is counted here rather than by the caller.
+            if await self.serveFromCache(url, fields, writer, keepAlive):
+                self.metrics.counters['cache_hits'] += 1
+                return keepAlive
+            self.metrics.counters['cache_misses'] += 1
+            return await self.forwardRequest(request, True, writer, keepAlive)
+
+        self.metrics.counters['cache_misses'] += 1
+        inflight = asyncio.get_running_loop().create_future()
+        self.inflight[url] = inflight
+        try:
+            return await self.forwardRequest(request, True, writer, keepAlive)
+        finally:
+            del self.inflight[url]
+            inflight.set_result(None)
+
+    async def handleRequest(self, head, reader, writer):
+        #Returns True if the client connection can be used for another request.
+        request = self.parseRequestHead(head, len(head) - 4)
+        if isinstance(request, int):
+            return await self.sendError(writer, request, REFUSAL_REASONS[request])
+        method, url, version, fields = request
+        #Forwarded with the lower-cased names, HTTP field names aren't case sensitive.
+        headers = list(fields.items())
+        keepAlive = self.isKeepAlive(version, fields)
+        self.metrics.counters['requests'] += 1
+
+        #Framing is checked first: a reply sent before the request body has been read on must close the
+        #connection, or the unread body would be taken for the client's next request.
+        if 'transfer-encoding' in fields:
+            return await self.sendError(writer, 411, 'Length Required')
+        body_Length = self.contentLength(fields)
+        if body_Length < 0:
+            return await self.sendError(writer, 400, 'Bad Request')
+
+        if url.partition('?')[0] == METRICS_PATH:
+            keepAlive = keepAlive and not body_Length
+            body = self.metrics.render(self.metricGauges())
+            hdr = "HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: %d\r\nConnection: %s\r\n\r\n" % (
+                len(body), 'keep-alive' if keepAlive else 'close')
+            writer.write(hdr.encode() + body)
+            await writer.drain()
+            return keepAlive
+
+        if method == 'CONNECT':
+            return await self.openTunnel(url, reader, writer)
+        target = urllib.parse.urlsplit(url)
+        if target.scheme != 'http' or not target.hostname:
+            return await self.sendError(writer, 400, 'Bad Request')
+
+        #Only plain GETs without credentials are shared through the cache.
+        requestDirectives = fields.get('cache-control', '').lower()
+        cacheable = (method == 'GET' and not body_Length and 'authorization' not in fields
+                     and 'no-store' not in requestDirectives)
+        if cacheable and 'no-cache' not in requestDirectives and 'no-cache' not in fields.get('pragma', ''):
+            if await self.serveFromCache(url, fields, writer, keepAlive):
+                self.metrics.counters['cache_hits'] += 1
+                return keepAlive
+            return await self.fetchCoalesced((method, url, version, headers, fields), writer, keepAlive)
+
+        return await self.forwardRequest((method, url, version, headers, fields), cacheable,
+                                         writer, keepAlive, reader, body_Length)
+
+    async def pumpTunnel(self, reader, writer, activity):
+        #Copies one direction of a tunnel, returning False if either side failed. Only TUNNEL_BUFFER_SIZE is
+        #read at a time and drain() waits while the other side's write buffer is over its limit, so a slow
+        #receiver stops us reading from the sender instead of piling data up in memory.
+        try:
+            while True:
+                chunk = await reader.read(TUNNEL_BUFFER_SIZE)
+                if not chunk:
+                    break
+                activity[0] = time.monotonic()
+                self.metrics.counters['tunnel_bytes'] += len(chunk)
+                writer.write(chunk)
+                await writer.drain()
+            #Pass the half-close on, the other direction keeps going until it finishes too.
+            if writer.can_write_eof():
+                writer.write_eof()
+            return True
+        except (ConnectionError, OSError):
+            return False
+
+    async def openTunnel(self, authority, reader, writer):
+        #CONNECT host:port, relaying bytes both ways until both sides have finished or it sits idle.
+        #The client connection can't carry HTTP again afterwards, so this always returns False.
+        host, separator, port = authority.rpartition(':')
+        host = host.strip('[]')
+        if not separator or not host or not port.isdigit():
+            return await self.sendError(writer, 400, 'Bad Request')
+        #Otherwise anyone could use us to reach any service, not just tunnel HTTPS.
+        if int(port) not in self.connectPorts:
+            return await self.sendError(writer, 403, 'Forbidden')
+
+        try:
+            upstreamReader, upstreamWriter = await asyncio.wait_for(
+                asyncio.open_connection(host, int(port), limit=TUNNEL_BUFFER_SIZE), self.upstreamTimeout)
+        except asyncio.TimeoutError:
+            return await self.sendError(writer, 504, 'Gateway Timeout')
+        except OSError:
+            return await self.sendError(writer, 502, 'Bad Gateway')
+
+        self.metrics.counters['tunnels'] += 1
+        self.openTunnels += 1
+        try:
+            writer.write(b'HTTP/1.1 200 Connection Established\r\n\r\n')
+            await writer.drain()
+            for side in (writer, upstreamWriter):
+                side.transport.set_write_buffer_limits(high=TUNNEL_BUFFER_SIZE)
+
+            #Anything the client sent straight after the CONNECT head is still in reader and goes through first.
+            activity = [time.monotonic()]
+            pumps = {asyncio.create_task(self.pumpTunnel(reader, upstreamWriter, activity)),
+                     asyncio.create_task(self.pumpTunnel(upstreamReader, writer, activity))}
+            pending = pumps
+            try:
+                while pending:
+                    idleFor = time.monotonic() - activity[0]
+                    if idleFor >= self.tunnelTimeout:
+                        break
+                    done, pending = await asyncio.wait(pending, timeout=self.tunnelTimeout - idleFor)
+                    if not all(pump.result() for pump in done):
+                        break
+            finally:
+                for pump in pumps:
+                    pump.cancel()
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self.openTunnels -= 1
+            upstreamWriter.close()
+        return False
+
+    async def handleClient(self, reader, writer):
+        try:
+            keepAlive = True
+            while keepAlive:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), self.idleTimeout)
+                except asyncio.LimitOverrunError:
+                    await self.sendError(writer, 431, 'Request Header Fields Too Large')
+                    break
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError):
+                    break
+                keepAlive = await self.handleRequest(head, reader, writer)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, args):
+        server = await asyncio.start_server(self.handleClient, '', args.port,
+                                            limit=MAX_REQUEST_SIZE, backlog=args.backlog)
+        tasks = [asyncio.create_task(self.evictIdleUpstreams())]
+        if args.stats_interval > 0:
+            tasks.append(asyncio.create_task(self.printStats(args.stats_interval)))
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for task in tasks:
+                task.cancel()
+            self.pool.closeAll()
+
+    def metricGauges(self):
+        return {
+            'cache_bytes': ('Bytes of response bodies in the disk cache.', self.cache.totalBytes),
+            'cache_entries': ('Responses in the disk cache.', len(self.cache.entries)),
+            'idle_upstream_connections': ('Idle pooled connections to origin servers.',
+                                          sum(len(connections) for connections in self.pool.idle.values())),
+            'inflight_fetches': ('Cache fills in progress that other requests can wait on.', len(self.inflight)),
+            'open_tunnels': ('CONNECT tunnels currently open.', self.openTunnels),
+        }
+
+    async def printStats(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            print(self.metrics.statsLine(self.metricGauges()), file=sys.stderr, flush=True)
+
+    async def evictIdleUpstreams(self):
+        while True:
+            await asyncio.sleep(max(0.5, self.pool.idleTimeout / 2))
+            self.pool.evictIdle()
 
     def __init__(self, args):
         print('Web Proxy starting on port: %i...' % (args.port))
+        # 1. Create server socket and listen for clients
+        # 2. Parse the absolute URL out of each request
+        # 3. Serve fresh responses straight from the disk cache
+        # 4. Otherwise forward the request to the origin server
+        # 5. Relay the response to the client, storing it in the cache when allowed
+
+        self.upstreamTimeout = args.timeout
+        self.idleTimeout = args.keepalive_timeout
+        self.tunnelTimeout = args.tunnel_timeout
+        self.openTunnels = 0
+        try:
+            self.connectPorts = {int(port) for port in args.connect_ports.split(',')}
+        except ValueError:
+            print('CONNECT ports must be a comma separated list of port numbers')
+            return
+
+        #Every tunnel holds two sockets, so raise the open file limit as far as we're allowed to.
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft != hard:
+            try:
+                resource.setrlimit(resource.RLIMIT_NOFILE, (hard if hard != resource.RLIM_INFINITY else max(soft, 65536), hard))
+            except (ValueError, OSError):
+                pass
+        self.cache = ProxyDiskCache(args.cache_dir, args.cache_size, args.max_object_size)
+        self.pool = UpstreamPool(args.max_idle_upstream, args.upstream_idle_timeout)
+        #URL -> future resolved when the fetch currently filling the cache for it finishes.
+        self.inflight = {}
+        self.metrics = ServerMetrics('proxy', {
+            'requests': 'Requests received from clients.',
+            'cache_hits': 'Requests answered from the disk cache.',
+            'cache_misses': 'Cacheable requests the disk cache could not answer.',
+            'coalesced': 'Misses that waited on another request already fetching the same URL.',
+            'upstream_requests': 'Requests sent to origin servers.',
+            'upstream_reused': 'Origin requests sent on a pooled keep-alive connection.',
+            'upstream_errors': 'Origin requests that failed with a 502 or 504.',
+            'tunnels': 'CONNECT tunnels opened.',
+            'tunnel_bytes': 'Bytes relayed through CONNECT tunnels in either direction.',
+        }, {
+            'upstream': 'Time from getting an origin connection to its response head arriving.',
+        })
+
+        try:
+            asyncio.run(self.serve(args))
+        except KeyboardInterrupt:
+            print('Proxy terminated.')
+
+class Benchmark(NetworkApplication):
+    #Loopback load test of the web server or proxy plus microbenchmarks of the ICMP packet code.
+    #Servers run as child processes of this script so the load generator never shares their interpreter.
+
+    def startServer(self, arguments, directory, port):
+        process = subprocess.Popen([sys.executable, os.path.abspath(__file__)] + arguments, cwd=directory,
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self.servers.append(process)
+        deadline = time.monotonic() + BENCHMARK_START_TIMEOUT
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError('%s exited with status %d' % (arguments[0], process.returncode))
+            try:
+                socket.create_connection(('127.0.0.1', port), 0.5).close()
+                return
+            except OSError:
+                time.sleep(0.05)
+        raise RuntimeError('%s did not start listening on port %d' % (arguments[0], port))
+
+    def stopServers(self):
+        for process in self.servers:
+            process.terminate()
+        for process in self.servers:
+            try:
+                process.wait(SHUTDOWN_GRACE_PERIOD)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+        self.servers = []
+
+    async def runClient(self, port, request, until, statistics, totals):
+        #One keep-alive client sending requests back to back, reconnecting whenever the server closes.
+        reader = writer = None
+        try:
+            while time.perf_counter() < until:
+                if writer is None:
+                    reader, writer = await asyncio.open_connection('127.0.0.1', port, limit=MAX_REQUEST_SIZE)
+                started = time.perf_counter()
+                writer.write(request)
+                head = await reader.readuntil(b'\r\n\r\n')
+                lines = head[:-4].split(b'\r\n')
+                fields = self.headerFields(self.parseHeaders(lines[1:]) or [])
+                remaining = int(fields.get('content-length', 0))
+                while remaining:
+                    chunk = await reader.read(min(remaining, RECV_BUFFER_SIZE))
+                    if not chunk:
+                        raise asyncio.IncompleteReadError(b'', remaining)
+                    remaining -= len(chunk)
+                statistics.add((time.perf_counter() - started) * 1000)
+
+                if lines[0].split()[1:2] == [b'200']:
+                    totals['bytes'] += int(fields.get('content-length', 0))
+                else:
+                    totals['errors'] += 1
+                if 'close' in fields.get('connection', '').lower():
+                    writer.close()
+                    writer = None
+        except (OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError):
+            totals['errors'] += 1
+        finally:
+            if writer is not None:
+                writer.close()
+
+    async def loadTest(self, port, request, clients, duration):
+        statistics = PingStatistics()
+        totals = {'bytes': 0, 'errors': 0}
+        started = time.perf_counter()
+        until = started + duration
+        await asyncio.gather(*(self.runClient(port, request, until, statistics, totals)
+                               for i in range(clients)))
+        elapsed = time.perf_counter() - started
+        return {
+            'requests': statistics.received,
+            'errors': totals['errors'],
+            'requests_per_sec': statistics.received / elapsed,
+            'throughput_mib_per_sec': totals['bytes'] / elapsed / 1048576,
+            'mean_ms': statistics.mean,
+            'p50_ms': statistics.percentile(50),
+            'p99_ms': statistics.percentile(99),
+            'p999_ms': statistics.percentile(99.9),
+            'max_ms': statistics.maximum,
+        }
+
+    def runLoad(self, args, sizes, directory):
+        #Returns results keyed by file size. The proxy is measured forwarding to a web server behind it.
+        for size in sizes:
+            with open(os.path.join(directory, 'bench-%d.bin' % (size)), 'wb') as benchFile:
+                benchFile.write(os.urandom(size))
+
+        serverArguments = ['--max-requests', '1000000000'] + (args.server_arg or [])
+        if args.server == 'web':
+            self.startServer(['web', '--port', str(args.port)] + serverArguments, directory, args.port)
+            target = '/bench-%d.bin'
+        else:
+            originPort = args.port + 1
+            self.startServer(['web', '--port', str(originPort)] + serverArguments, directory, originPort)
+            self.startServer(['proxy', '--port', str(args.port), '--cache-dir', os.path.join(directory, 'cache')],
+                             directory, args.port)
+            target = 'http://127.0.0.1:%d/bench-%%d.bin' % (originPort)
+
+        #Each size keeps its fastest run, anything else on the machine only ever slows a run down.
+        results = {}
+        for size in sizes:
+            request = ('GET %s HTTP/1.1\r\nHost: 127.0.0.1:%d\r\n\r\n' % (target % (size), args.port)).encode()
+            runs = [asyncio.run(self.loadTest(args.port, request, args.clients, args.duration))
+                    for run in range(args.runs)]
+            results[str(size)] = max(runs, key=lambda run: run['requests_per_sec'])
+        return results
+
+    def timeOperation(self, operation):
+        #Nanoseconds per call, best of several runs each long enough to be timed reliably.
+        timer = timeit.Timer(operation)
+        number, elapsed = timer.autorange()
+        best = min([elapsed] + timer.repeat(BENCHMARK_REPEATS, number))
+        return best / number * 1e9
+
+    def runMicro(self):
+        results = {}
+        for size in (64, 1500, 65507):
+            data = os.urandom(size)
+            results['checksum_%d_ns' % (size)] = self.timeOperation(lambda: self.checksum(data))
+        packet = self.buildEchoRequest(ID, 1)
+        results['build_echo_request_ns'] = self.timeOperation(lambda: self.buildEchoRequest(ID, 1))
+        fixedSum = self.echoFixedSum(packet)
+        results['update_echo_request_ns'] = self.timeOperation(lambda: self.updateEchoRequest(packet, 2, fixedSum))
+        reply = bytes([0x45]) + bytes(19) + bytes(packet)
+        results['parse_icmp_reply_ns'] = self.timeOperation(lambda: self.parseICMPReply(reply))
+        head = bytearray(b'GET /index.html HTTP/1.1\r\nHost: 127.0.0.1\r\nUser-Agent: benchmark\r\n'
+                         b'Accept: */*\r\nAccept-Encoding: gzip\r\n\r\n')
+        results['parse_request_head_ns'] = self.timeOperation(
+            lambda: self.parseRequestHead(head, len(head) - 4))
+        return results
+
+    def compareWithBaseline(self, results, baseline, tolerance, microTolerance):
+        #Returns the metrics more than tolerance worse than the baseline. Rates should not fall,
+        #latencies and times per call should not rise. Tail latencies are left out, a few seconds of
+        #load is too short for them to repeat. Sub-microsecond timings swing with CPU frequency and
+        #cache state even as a best of several runs, so they get their own tolerance.
+        regressions = []
+        for section, allowed in (('load', tolerance), ('micro', microTolerance)):
+            for key, value in results.get(section, {}).items():
+                old = baseline.get(section, {}).get(key)
+                metrics = value.items() if isinstance(value, dict) else [(None, value)]
+                for metric, current in metrics:
+                    previous = old.get(metric) if isinstance(old, dict) else old
+                    if metric in ('requests', 'errors', 'p99_ms', 'p999_ms', 'max_ms') or not previous:
+                        continue
+                    change = (current - previous) / previous
+                    if (metric or key).endswith('_per_sec'):
+                        change = -change
+                    name = key if metric is None else '%s %s' % (key, metric)
+                    if change > allowed:
+                        regressions.append((name, previous, current, change))
+        return regressions
+
+    def printResults(self, args, results):
+        if 'load' in results:
+            print('%s: %d clients, %.1f s per file size' % (args.server, args.clients, args.duration))
+            print('%10s %10s %9s %9s %9s %9s %7s' % ('size', 'req/s', 'MiB/s', 'p50 ms', 'p99 ms', 'p999 ms', 'errors'))
+            for size, load in results['load'].items():
+                print('%10s %10.1f %9.2f %9.3f %9.3f %9.3f %7d' % (size, load['requests_per_sec'],
+                      load['throughput_mib_per_sec'], load['p50_ms'], load['p99_ms'], load['p999_ms'],
+                      load['errors']))
+        if 'micro' in results:
+            for name, nanoseconds in results['micro'].items():
+                print('%-28s %12.1f ns' % (name[:-3], nanoseconds))
+
+    def __init__(self, args):
+        # 1. Start the server being measured on localhost in a scratch directory
+        # 2. Drive it with keep-alive clients, one file size at a time
+        # 3. Time the ICMP checksum and packet building code
+        # 4. Report as text and JSON and compare against a saved baseline
+        try:
+            sizes = [int(size) for size in args.sizes.split(',')]
+        except ValueError:
+            print('File sizes must be a comma separated list of byte counts')
+            return
+        if args.runs < 1:
+            print('At least one load test run is needed')
+            return
+
+        self.servers = []
+        #Kept with the numbers so a saved baseline says what it was measured on.
+        results = {'environment': {'machine': platform.machine(), 'processor': platform.processor(),
+                                   'cpus': os.cpu_count(), 'system': platform.platform(),
+                                   'python': '%s %s' % (platform.python_implementation(), platform.python_version()),
+                                   'numpy': numpy.__version__ if numpy is not None else None,
+                                   'server': args.server, 'clients': args.clients, 'duration': args.duration,
+                                   'runs': args.runs}}
+        if not args.skip_load:
+            with tempfile.TemporaryDirectory() as directory:
+                try:
+                    results['load'] = self.runLoad(args, sizes, directory)
+                except RuntimeError as error:
+                    print('Benchmark failed: %s' % (error))
+                    return
+                finally:
+                    self.stopServers()
+        if not args.skip_micro:
+            results['micro'] = self.runMicro()
+        self.printResults(args, results)
+
+        if args.json == '-':
+            print(json.dumps(results, indent=2))
+        elif args.json:
+            with open(args.json, 'w') as jsonFile:
+                json.dump(results, jsonFile, indent=2)
+        if args.save_baseline:
+            with open(args.save_baseline, 'w') as baselineFile:
+                json.dump(results, baselineFile, indent=2)
+
+        if args.baseline:
+            with open(args.baseline) as baselineFile:
+                regressions = self.compareWithBaseline(results, json.load(baselineFile),
+                                                       args.tolerance, args.micro_tolerance)
+            for name, previous, current, change in regressions:
+                print('REGRESSION %s: %.3f -> %.3f (%.1f%% worse)' % (name, previous, current, change * 100))
+            if regressions:
+                sys.exit(1)
+            print('No regressions against %s' % (args.baseline))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,165 @@
+import importlib.util
+import os
+import random
+import struct
+import unittest
+
+#The module's file name has a hyphen in it so it can't be imported by name.
+spec = importlib.util.spec_from_file_location('network_applications',
+                                              os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                           'NetworkApplications-2.py'))
+network_applications = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(network_applications)
+
+
+def makeWebServer(documentRoot='/srv/www'):
+    #WebServer.__init__ starts serving, the parsing methods only need the document root.
+    webServer = object.__new__(network_applications.WebServer)
+    webServer.documentRoot = documentRoot
+    return webServer
+
+
+def referenceChecksum(data):
+    #RFC 1071 section 4.1 word by word: add up 16-bit words, fold the carries in, complement. Words are
+    #little-endian and the result byte swapped, the form NetworkApplication.checksum returns.
+    if len(data) % 2:
+        data = data + b'\0'
+    total = 0
+    for i in range(0, len(data), 2):
+        total += data[i] | data[i + 1] << 8
+    while total >> 16:
+        total = (total >> 16) + (total & 0xffff)
+    answer = ~total & 0xffff
+    return answer >> 8 | (answer << 8 & 0xff00)
+
+
+def checksumVerifies(packet):
+    #A packet with a correct checksum in it sums to 0xffff.
+    total = sum(packet[i] << 8 | packet[i + 1] for i in range(0, len(packet), 2))
+    while total >> 16:
+        total = (total >> 16) + (total & 0xffff)
+    return total == 0xffff
+
+
+class ChecksumTests(unittest.TestCase):
+
+    def setUp(self):
+        self.application = object.__new__(network_applications.NetworkApplication)
+
+    def test_matches_rfc_1071_for_odd_and_even_lengths(self):
+        rng = random.Random(1071)
+        for length in list(range(0, 40)) + [1499, 1500, 4095, 4096, 65507]:
+            data = bytes(rng.randrange(256) for _ in range(length))
+            self.assertEqual(self.application.checksum(data), referenceChecksum(data), length)
+
+    def test_sums_that_are_multiples_of_0xffff(self):
+        for data in (b'', b'\0', b'\0\0', b'\xff\xff', b'\xff\xff' * 7, b'\xfe\xff\x01\x00',
+                     b'\x01\x00\xfe\xff\x00', b'\xff', b'\x00\xff\xff\x00'):
+            self.assertEqual(self.application.checksum(data), referenceChecksum(data), data)
+
+    def test_built_echo_requests_verify(self):
+        for identifier in (0, 1, 0x1234, 0xffff):
+            self.assertTrue(checksumVerifies(self.application.buildEchoRequest(identifier, 7)))
+
+    def test_updated_echo_requests_verify(self):
+        for identifier in (0, 1, 0xf7ff, 0xf800, 0xfffe, 0xffff):
+            packet = self.application.buildEchoRequest(identifier, 0)
+            fixedSum = self.application.echoFixedSum(packet)
+            for sequence in range(0, 0x10000, 97):
+                self.application.updateEchoRequest(packet, sequence, fixedSum)
+                self.assertTrue(checksumVerifies(packet), (identifier, sequence))
+                self.assertEqual(struct.unpack_from('=H', packet, 6)[0], sequence)
+            self.application.updateEchoRequest(packet, 0xffff)
+            self.assertTrue(checksumVerifies(packet))
+
+    def test_echo_requests_with_a_payload_are_refused(self):
+        packet = self.application.buildEchoRequest(1, 0) + b'payload!'
+        with self.assertRaises(ValueError):
+            self.application.echoFixedSum(packet)
+
+
+class ResolvePathTests(unittest.TestCase):
+
+    def setUp(self):
+        self.webServer = makeWebServer()
+
+    def test_plain_paths_resolve_under_the_root(self):
+        self.assertEqual(self.webServer.resolvePath('/index.html'), '/srv/www/index.html')
+        self.assertEqual(self.webServer.resolvePath('/a/b.css?v=2#top'), '/srv/www/a/b.css')
+        self.assertEqual(self.webServer.resolvePath('//etc/passwd'), '/srv/www/etc/passwd')
+
+    def test_directories_serve_index_html(self):
+        self.assertEqual(self.webServer.resolvePath('/'), '/srv/www/index.html')
+        self.assertEqual(self.webServer.resolvePath('/a/./b/'), '/srv/www/a/b/index.html')
+
+    def test_dot_segments_inside_the_root_are_resolved(self):
+        self.assertEqual(self.webServer.resolvePath('/a/../b'), '/srv/www/b')
+        self.assertEqual(self.webServer.resolvePath('/a/%2e%2e/b'), '/srv/www/b')
+
+    def test_traversal_out_of_the_root_is_refused(self):
+        for target in ('/../etc/passwd', '/a/../../etc/passwd', '/%2e%2e/etc/passwd', '/%2E%2E/etc/passwd',
+                       '/..%2fetc/passwd', '/a/..%2f..%2fetc/passwd', '/%2e%2e%2f%2e%2e%2fetc/passwd'):
+            self.assertIsNone(self.webServer.resolvePath(target), target)
+
+    def test_nul_and_undecodable_targets_are_refused(self):
+        self.assertIsNone(self.webServer.resolvePath('/index.html%00.txt'))
+        self.assertIsNone(self.webServer.resolvePath('/%ff'))
+
+    def test_absolute_form_targets(self):
+        self.assertEqual(self.webServer.resolvePath('http://example.com/a.html'), '/srv/www/a.html')
+        self.assertEqual(self.webServer.resolvePath('http://example.com'), '/srv/www/index.html')
+        self.assertIsNone(self.webServer.resolvePath('http://example.com/../etc/passwd'))
+        self.assertIsNone(self.webServer.resolvePath('*'))
+
+
+class ParseRangeTests(unittest.TestCase):
+
+    def setUp(self):
+        self.webServer = makeWebServer()
+
+    def test_single_ranges(self):
+        self.assertEqual(self.webServer.parseRange('bytes=0-9', 100), [(0, 9)])
+        self.assertEqual(self.webServer.parseRange('bytes=95-', 100), [(95, 99)])
+        self.assertEqual(self.webServer.parseRange('bytes=-5', 100), [(95, 99)])
+        self.assertEqual(self.webServer.parseRange('bytes=90-200', 100), [(90, 99)])
+
+    def test_overlapping_ranges_are_merged(self):
+        self.assertEqual(self.webServer.parseRange('bytes=0-9,5-20', 100), [(0, 20)])
+        self.assertEqual(self.webServer.parseRange('bytes=0-1,3-4', 100), [(0, 1), (3, 4)])
+
+    def test_unsatisfiable_ranges(self):
+        self.assertEqual(self.webServer.parseRange('bytes=100-', 100), [])
+        self.assertEqual(self.webServer.parseRange('bytes=-0', 100), [])
+
+    def test_malformed_ranges_are_ignored(self):
+        for value in ('items=0-1', 'bytes=abc', 'bytes=9-0', 'bytes='):
+            self.assertIsNone(self.webServer.parseRange(value, 100), value)
+
+
+class ParseRequestHeadTests(unittest.TestCase):
+
+    def setUp(self):
+        self.webServer = makeWebServer()
+
+    def parse(self, head):
+        buffer = bytearray(head + b'\r\n\r\n')
+        return self.webServer.parseRequestHead(buffer, len(head))
+
+    def test_fields_are_lower_cased_and_repeats_joined(self):
+        self.assertEqual(self.parse(b'GET /a HTTP/1.1\r\nHost: x\r\nAccept: a\r\naccept:  b '),
+                         ('GET', '/a', 'HTTP/1.1', {'host': 'x', 'accept': 'a, b'}))
+
+    def test_malformed_heads_are_refused(self):
+        for head in (b'GET HTTP/1.1', b'GET /a HTTP/2', b'GET /a  HTTP/1.1', b'G(T /a HTTP/1.1',
+                     b'GET /a HTTP/1.1\r\nHost : x', b'GET /a HTTP/1.1\r\nBad Header: y',
+                     b'GET /a HTTP/1.1\r\nHost: x\r\n folded', b'GET /a HTTP/1.1\r\nNoColon'):
+            self.assertEqual(self.parse(head), 400, head)
+
+    def test_size_limits(self):
+        self.assertEqual(self.parse(b'GET /' + b'a' * network_applications.MAX_REQUEST_LINE + b' HTTP/1.1'), 414)
+        fields = b''.join(b'\r\nX-%d: y' % i for i in range(network_applications.MAX_HEADER_FIELDS + 1))
+        self.assertEqual(self.parse(b'GET /a HTTP/1.1' + fields), 431)
+
+
+if __name__ == '__main__':
+    unittest.main()